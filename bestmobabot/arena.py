@@ -5,25 +5,35 @@ Arena hero selection logic.
 from __future__ import annotations
 
 import pickle
-from base64 import b85decode
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing, suppress
 from dataclasses import dataclass
-from functools import total_ordering
+from datetime import timedelta
+from functools import partial, total_ordering
+from hashlib import sha1
 from itertools import combinations, count, product
+from operator import attrgetter
 from pathlib import Path
-from typing import Any, Callable, Dict, Iterable, List, MutableMapping, Optional, TypeVar
+from time import monotonic, time
+from typing import Any, Callable, Dict, Iterable, List, MutableMapping, Optional, Tuple, TypeVar
 
 import click
 import numpy
 from loguru import logger
 from numpy import arange, ndarray, vstack
 from numpy.random import choice, permutation, randint
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.special import expit
 
 import bestmobabot.logging_
 from bestmobabot import constants
 from bestmobabot.constants import TEAM_SIZE
 from bestmobabot.database import Database
 from bestmobabot.dataclasses_ import ArenaEnemy, BaseArenaEnemy, GrandArenaEnemy, Hero, Loggable
-from bestmobabot.itertools_ import CountDown, secretary_max, slices
+from bestmobabot.features import FeatureVectorizer, HeroTable
+from bestmobabot.itertools_ import CountDown, prefetch, secretary_max, slices
 from bestmobabot.model import Model
 
 T = TypeVar('T')
@@ -39,6 +49,7 @@ class ArenaSolution(Loggable):
     attackers: List[List[Hero]]  # player's attacker teams
     probability: float  # arena win probability
     probabilities: List[float]  # individual battle win probabilities
+    n_generations: int = 0  # number of generations until the solution has been found
 
     @property
     def plain_text(self) -> Iterable[str]:
@@ -87,7 +98,7 @@ class ArenaSolver:
         db: MutableMapping[str, Any],
         model: Model,
         user_clan_id: Optional[str],
-        heroes: List[Hero],
+        heroes: Iterable[Hero],
         n_required_teams: int,
         max_iterations: int,
         n_keep_solutions: int,
@@ -96,8 +107,14 @@ class ArenaSolver:
         early_stop: float,
         get_enemies: Callable[[], List[BaseArenaEnemy]],
         friendly_clans: Iterable[str],
-        reduce_probabilities: Callable[..., ndarray],
         callback: Callable[[int], Any],
+        n_processes: int = 1,
+        enemy_time_budget: Optional[timedelta] = None,
+        time_budget: Optional[timedelta] = None,
+        user_id: Optional[str] = None,
+        solution_ttl: Optional[timedelta] = None,
+        surrogate_factor: int = 1,
+        memory_limit: Optional[int] = None,
     ):
         """
         :param model: prediction model.
@@ -111,14 +128,22 @@ class ArenaSolver:
         :param early_stop: minimal probability to attack the enemy immediately.
         :param get_enemies: callable to fetch an enemy page.
         :param friendly_clans: friendly clan IDs or titles.
-        :param reduce_probabilities: callable to combine probabilities from multiple battles into a final one.
         :param callback: callable which receives current arena enemies page.
+        :param n_processes: number of worker processes to solve enemies in parallel, `1` to solve in-process.
+        :param enemy_time_budget: maximum time to solve a single enemy, the best solution so far is taken then.
+        :param time_budget: maximum time of the entire enemy search.
+        :param user_id: current user ID to keep the population between runs, `None` to always start from scratch.
+        :param solution_ttl: for how long the solutions are reused from the database, `None` to not store them.
+        :param surrogate_factor: how many times more children are ranked by the linear surrogate of the model, if any.
+        :param memory_limit: approximate memory limit of the enemy searches in megabytes, `None` to not limit.
         """
 
         self.db = db
-        self.model = model
+        self.model = model if model.forest is not None else model.compile()
         self.user_clan_id = user_clan_id
-        self.heroes = heroes
+        self.vectorizer = FeatureVectorizer(model.feature_names)
+        self.heroes = HeroTable(heroes, self.vectorizer)
+        self.hero_features = self.heroes.features[:, self.model.forest.used_features].toarray()
         self.n_required_teams = n_required_teams
         self.max_iterations = max_iterations
         self.n_keep_solutions = n_keep_solutions
@@ -127,35 +152,220 @@ class ArenaSolver:
         self.early_stop = early_stop
         self.get_enemies = get_enemies
         self.friendly_clans = set(friendly_clans)
-        self.reduce_probabilities = reduce_probabilities
+        # Win probability is the probability to win the most of the battles.
+        self.reduce_probabilities = partial(reduce_at_least, n_required_teams // 2 + 1)
         self.callback = callback
+        self.n_processes = n_processes
+        self.enemy_time_budget = enemy_time_budget
+        self.time_budget = time_budget
+        self.user_id = user_id
+        self.solution_ttl = solution_ttl
+        self.surrogate_factor = surrogate_factor
+        self.hero_scores: Optional[ndarray] = None  # linear surrogate scores, if the surrogate is to be used
+        if self.model.surrogate is not None and surrogate_factor > 1:
+            self.hero_scores = self.heroes.features @ self.model.surrogate.coef
+        self.memory_limit = memory_limit
 
         # If the same enemy is encountered again, we will use the earlier solution.
         self.cache: Dict[str, ArenaSolution] = {}
 
+        # Seed solutions made while screening the enemies. They're taken by the enemy searches.
+        self.seeds: Dict[str, ndarray] = {}
+
+        # Match-up signatures of the solutions stored in the database start with the model and heroes digest.
+        self.signature_prefix = b''
+
+        # Battle predictions are memoized, since kept solutions and duplicate children are predicted over and over.
+        self.memo = PredictionMemo(
+            constants.ARENA_PREDICTION_MEMO_SIZE,
+            max(1, constants.ARENA_PREDICTION_CHUNK_MEMORY // self.hero_features[0].nbytes),
+        )
+        self.defenders_keys: Dict[bytes, int] = {}
+
+        # Inference statistics.
+        self.n_predict_calls = 0
+        self.n_predict_rows = 0
+
         # We keep solutions in an attribute because we want to retry the best solutions across different enemies.
         self.solutions = numpy.array([[]])
 
-    def solve(self) -> ArenaSolution:
+        # Worker processes pool, only exists during `solve` in the parallel mode.
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+        # Monotonic time of the entire search end.
+        self.deadline: Optional[float] = None
+
+        self.shrink_population()
+
+    def solve(self) -> Optional[ArenaSolution]:
+        """
+        Selects the best enemy and solution. Returns `None` if there's no suitable enemy at all.
+        """
         self.initialize()
-        return secretary_max(self.yield_solutions(), self.max_iterations, early_stop=self.early_stop)
+        if self.time_budget is not None:
+            self.deadline = monotonic() + self.time_budget.total_seconds()
+        if self.n_processes > 1:
+            logger.debug('Starting {} worker processes…', self.n_processes)
+            self.executor = ProcessPoolExecutor(
+                self.n_processes,
+                initializer=initialize_worker,
+                initargs=(self.solutions, dict(
+                    model=self.model,
+                    heroes=self.heroes.heroes,
+                    n_required_teams=self.n_required_teams,
+                    n_keep_solutions=self.n_keep_solutions,
+                    n_generate_solutions=self.n_generate_solutions,
+                    n_generations_count_down=self.n_generations_count_down,
+                    early_stop=self.early_stop,
+                    enemy_time_budget=self.enemy_time_budget,
+                    surrogate_factor=self.surrogate_factor,
+                    memory_limit=self.memory_limit,
+                )),
+            )
+            # Fork the workers right away, before the enemy prefetching thread is started.
+            self.executor.submit(int).result()
+        try:
+            with closing(self.yield_solutions()) as solutions:
+                solution = secretary_max(solutions, self.max_iterations, early_stop=self.early_stop)
+        finally:
+            if self.executor is not None:
+                # Don't wait for the abandoned enemies, the workers will exit as soon as they finish them.
+                self.executor.shutdown(wait=False)
+                self.executor = None
+        if solution is not None:
+            self.store_population(solution)
+        return solution
 
     def initialize(self) -> ArenaSolver:
         logger.debug('Generating initial solutions…')
-        self.solutions = vstack([permutation(len(self.heroes)) for _ in range(self.n_keep_solutions)])
+        solutions = [self.reconcile_layout(layout) for layout in self.load_population()][:self.n_keep_solutions]
+        if solutions:
+            logger.debug('Restored {} solutions from the previous run.', len(solutions))
+        solutions.extend(permutation(len(self.heroes)) for _ in range(self.n_keep_solutions - len(solutions)))
+        self.solutions = vstack(solutions)
+        self.load_solutions()
         return self
 
+    @property
+    def population_key(self) -> Optional[str]:
+        """
+        Database key to store the population between runs.
+        """
+        return f'arena:{self.n_required_teams}:{self.user_id}:population' if self.user_id is not None else None
+
+    def load_population(self) -> List[List[str]]:
+        return self.db.get(self.population_key, []) if self.population_key is not None else []
+
+    def store_population(self, solution: ArenaSolution):
+        """
+        Store the population as hero ID layouts, so that it survives the roster changes.
+        The chosen solution goes first since the population may belong to a different enemy.
+        """
+        if self.population_key is None:
+            return
+        layouts = {
+            tuple(hero.id for team in solution.attackers for hero in team): None,
+            **{tuple(self.heroes.ids[row].tolist()): None for row in self.solutions},
+        }
+        self.db[self.population_key] = [list(layout) for layout in layouts][:self.n_keep_solutions]
+
+    @property
+    def solution_prefix(self) -> str:
+        """
+        Database key prefix to store the solutions between runs. Each match-up signature has its own key.
+        """
+        return f'arena:{self.n_required_teams}:solution:'
+
+    def load_solutions(self):
+        """
+        Evicts the expired stored solutions and makes the signature prefix.
+        """
+        if self.solution_ttl is None:
+            return
+        timestamp = time()
+        for key, value in self.db.get_by_prefix(self.solution_prefix):
+            if value['expires_at'] <= timestamp:
+                # Another account may have evicted it just now.
+                with suppress(KeyError):
+                    del self.db[key]
+
+        # The same match-up gives the same solution as long as the model and our heroes are the same.
+        forest = self.model.forest
+        digest = sha1()
+        for array in (forest.features, forest.thresholds, forest.values, self.hero_features):
+            digest.update(array.tobytes())
+        digest.update(' '.join(self.heroes.ids).encode())
+        self.signature_prefix = digest.digest()
+
+    def get_signature(self, enemy: BaseArenaEnemy) -> str:
+        """
+        Gets the match-up signature: the model, our heroes and the enemy teams.
+        """
+        digest = sha1(self.signature_prefix)
+        for team in enemy.teams[:self.n_required_teams]:
+            digest.update(self.make_team_features(team).sum(axis=0).tobytes())
+        return digest.hexdigest()
+
+    def get_stored_solution(self, enemy: BaseArenaEnemy) -> Optional[ArenaSolution]:
+        if self.solution_ttl is None:
+            return None
+        value = self.db.get(f'{self.solution_prefix}{self.get_signature(enemy)}')
+        if value is None or value['expires_at'] <= time():
+            return None
+        heroes = {hero.id: hero for hero in self.heroes}
+        return ArenaSolution(
+            enemy=enemy,
+            attackers=[[heroes[hero_id] for hero_id in team] for team in value['attackers']],
+            probability=value['probability'],
+            probabilities=value['probabilities'],
+        )
+
+    def store_solution(self, solution: ArenaSolution):
+        """
+        Stores the solution under its own key. The key is written once, since a stored match-up is never solved again.
+        """
+        if self.solution_ttl is None:
+            return
+        self.db[f'{self.solution_prefix}{self.get_signature(solution.enemy)}'] = {
+            'attackers': [[hero.id for hero in team] for team in solution.attackers],
+            'probability': float(solution.probability),
+            'probabilities': [float(probability) for probability in solution.probabilities],
+            'expires_at': time() + self.solution_ttl.total_seconds(),
+        }
+
+    def reconcile_layout(self, layout: List[str]) -> ndarray:
+        """
+        Converts the stored hero ID layout to a permutation of the current heroes.
+        Missing heroes are replaced with random spare ones, new heroes are put into the reserve.
+        """
+        indexes = {hero_id: index for index, hero_id in enumerate(self.heroes.ids)}
+        solution = [indexes.get(hero_id, -1) for hero_id in layout]
+        spares = iter(permutation(sorted(set(range(len(self.heroes))).difference(solution))).tolist())
+        solution = [index if index != -1 else next(spares, -1) for index in solution]
+        return numpy.array([*(index for index in solution if index != -1), *spares])
+
     def yield_solutions(self) -> Iterable[ArenaSolution]:
         """
-        Yield the best solution from each `get_enemies` call.
+        Yield the best solution from each `get_enemies` call. There are at most `max_iterations` calls.
+        When the time is up, no more pages are fetched, and the search stops as soon as there's a solution.
         """
-        for n_page in count(1):
-            logger.debug('Fetching enemies…')
-            self.callback(n_page)
-            if enemies := list(self.filter_enemies(self.get_enemies())):
-                yield max(self.solve_enemy_cached(enemy) for enemy in enemies)
-            else:
-                logger.debug('All enemies are filtered out on the current page.')
+        n_solutions = 0
+
+        # The next page is being fetched while the current one is being solved.
+        is_time_up = partial(self.is_time_up, self.deadline)
+        with closing(prefetch(self.get_enemies, self.max_iterations, is_time_up)) as pages:
+            for n_page, page in enumerate(pages, start=1):
+                if n_solutions and is_time_up():
+                    logger.warning('Time is up, stopping the enemy search.')
+                    break
+                self.callback(n_page)
+                if not (enemies := list(self.filter_enemies(page))):
+                    logger.debug('All enemies are filtered out on the current page.')
+                elif solutions := self.solve_enemies_cached(enemies):
+                    n_solutions += 1
+                    yield max(solutions)
+                else:
+                    logger.debug('All enemies are screened out on the current page.')
 
     def filter_enemies(self, enemies: Iterable[BaseArenaEnemy]) -> Iterable[BaseArenaEnemy]:
         """
@@ -197,123 +407,593 @@ class ArenaSolver:
         self.db[f'{enemy_key}:teams'] = [[hero.dict() for hero in team] for team in enemy.teams]
         self.db[f'{enemy_key}:place'] = enemy.place
 
-    def solve_enemy_cached(self, enemy: BaseArenaEnemy) -> ArenaSolution:
+    def solve_enemies_cached(self, enemies: List[BaseArenaEnemy]) -> List[ArenaSolution]:
         """
-        Makes use of the solution cache for repeated enemies.
+        Makes use of the solution cache for repeated enemies and of the stored solutions for known match-ups.
+        The rest of the enemies are solved in a single batch, or in the worker processes in the parallel mode.
         """
-        solution = self.cache.get(enemy.user_id)
-        if not solution:
-            solution = self.solve_enemy(enemy)
-            self.cache[enemy.user_id] = solution
-        else:
-            logger.debug('Cache hit: #{}.', enemy.user_id)
-        logger.success('{}', solution)
-        return solution
+        for enemy in enemies:
+            if enemy.user_id in self.cache:
+                logger.debug('Cache hit: #{}.', enemy.user_id)
+            elif (solution := self.get_stored_solution(enemy)) is not None:
+                logger.debug('Stored solution hit: #{}.', enemy.user_id)
+                self.cache[enemy.user_id] = solution
+        missing = self.screen_enemies([enemy for enemy in enemies if enemy.user_id not in self.cache])
+        solve_enemies = self.solve_enemies if self.executor is None else self.solve_enemies_parallel
+        for solution in solve_enemies(missing):
+            self.cache[solution.enemy.user_id] = solution
+            self.store_solution(solution)
+        # The parallel mode may abandon some enemies after an early stop.
+        solutions = [self.cache[enemy.user_id] for enemy in enemies if enemy.user_id in self.cache]
+        for solution in solutions:
+            logger.success('{}', solution)
+        return solutions
+
+    def screen_enemies(self, enemies: List[BaseArenaEnemy]) -> List[BaseArenaEnemy]:
+        """
+        Scores the enemies with the seed solutions and filters out the hopeless ones.
+        The evolution never ends up worse than its seeds, and it rarely improves them by more than the margin.
+        Thus, an enemy is only worth the evolution if its seeds are close enough to the best solution so far.
+        """
+        if not enemies:
+            return []
+        seeds = self.make_seeds(enemies, self.hero_features)
+        threshold = max([
+            *(probability for _, probability in seeds),
+            *(solution.probability for solution in self.cache.values()),
+        ]) - constants.ARENA_SCREENING_MARGIN
+        screened_enemies = []
+        for enemy, (enemy_seeds, probability) in zip(enemies, seeds):
+            if probability < threshold:
+                logger.debug('Skipped hopeless enemy {}: {:.1f}% seed.', enemy, 100.0 * probability)
+                continue
+            self.seeds[enemy.user_id] = enemy_seeds
+            screened_enemies.append(enemy)
+        return screened_enemies
+
+    def make_seeds(self, enemies: List[BaseArenaEnemy], hero_features: ndarray) -> List[Tuple[ndarray, float]]:
+        """
+        Makes solutions of disjoint attacker teams, each assigned to the defenders team it suits the most.
+        Teams are made of the strongest heroes by cheap greedy builders. Then each team is scored against
+        each defenders team, and the assignment problem is solved, so that the GA only has to refine the teams.
+        All the enemies are scored in one go. Returns the seeds and the best seed win probability of each enemy.
+        """
+        n_seeds = (self.n_keep_solutions + 1) // 2
+        strongest = numpy.argsort(-self.heroes.power, kind='stable')
+
+        xs = []
+        enemies_attackers = []
+        for enemy in enemies:
+            n_teams = len(enemy.teams)
+            n_attackers = n_teams * TEAM_SIZE
+
+            # Take the strongest heroes in blocks and in the snake draft order. Then random teams of the strong ones.
+            ranks = arange(n_attackers)
+            snake_teams = numpy.where((ranks // n_teams) % 2 == 0, ranks % n_teams, n_teams - 1 - ranks % n_teams)
+            attackers = [strongest[:n_attackers], strongest[:n_attackers][numpy.argsort(snake_teams, kind='stable')]]
+            n_candidates = min(len(self.heroes), 2 * n_attackers)
+            while len(attackers) < n_seeds:
+                attackers.append(choice(strongest[:n_candidates], n_attackers, replace=False))
+            attackers = numpy.array(attackers[:n_seeds]).reshape(n_seeds, n_teams, TEAM_SIZE)
+            enemies_attackers.append(attackers)
+
+            # Each team against each defenders team. Shape is seeds × attackers × defenders.
+            defenders_features = vstack([self.make_team_features(team).sum(axis=0) for team in enemy.teams])
+            team_features = hero_features[attackers].sum(axis=2)
+            x = team_features[:, :, numpy.newaxis, :] - defenders_features[numpy.newaxis, numpy.newaxis, :, :]
+            xs.append(x.reshape(-1, x.shape[-1]))
+
+        ys = self.predict_proba(vstack(xs))
+        result = []
+        for attackers, y in zip(enemies_attackers, numpy.split(ys, numpy.cumsum([x.shape[0] for x in xs[:-1]]))):
+            n_teams = attackers.shape[1]
+            seeds = []
+            seed_probabilities = []
+            for teams, team_scores in zip(attackers, y.reshape(n_seeds, n_teams, n_teams)):
+                # Maximize the product of the battle win probabilities.
+                team_indexes, defenders_indexes = linear_sum_assignment(-numpy.log(numpy.maximum(team_scores, 1e-6)))
+                team_indexes = team_indexes[numpy.argsort(defenders_indexes)]  # attackers team of each defenders
+                assigned = teams[team_indexes].ravel()
+                spare = permutation(numpy.setdiff1d(arange(len(self.heroes)), assigned))
+                seeds.append(numpy.concatenate((assigned, spare)))
+                seed_probabilities.append(team_scores[team_indexes, arange(n_teams)])
+            probabilities = self.reduce_probabilities(*numpy.array(seed_probabilities).T)
+            logger.trace('Seeded {} solutions.', len(seeds))
+            result.append((vstack(seeds), float(probabilities.max())))
+        return result
 
     def solve_enemy(self, enemy: BaseArenaEnemy) -> ArenaSolution:
         """
         Finds solution for the single enemy.
         """
+        return self.solve_enemies([enemy])[0]
+
+    def solve_enemies_parallel(self, enemies: List[BaseArenaEnemy]) -> List[ArenaSolution]:
+        """
+        Finds solutions for the enemies in the worker processes.
+        Solutions are collected as they complete, so that an early stop doesn't wait for the rest of the enemies.
+        """
+        futures = [
+            self.executor.submit(solve_enemy_in_worker, enemy, self.deadline, self.seeds.pop(enemy.user_id, None))
+            for enemy in enemies
+        ]
+        solutions: List[ArenaSolution] = []
+        best_solution = None
+        try:
+            for future in as_completed(futures):
+                solution, population = future.result()
+                solutions.append(solution)
+                # Keep the population of the best enemy to retry it on the next page, just like the sequential mode.
+                if best_solution is None or solution > best_solution:
+                    best_solution = solution
+                    self.solutions = population
+                if solution.probability >= self.early_stop:
+                    logger.debug('Early stop, abandoning the rest of the enemies.')
+                    break
+        finally:
+            for future in futures:
+                future.cancel()
+        return solutions
+
+    def estimate_memory(self) -> int:
+        """
+        Estimates peak memory of a single enemy search in megabytes. Feature rows take the most of it:
+        team features of the population with its children, the swap neighbourhood, the battles and the temporary ones.
+        """
+        n_teams = self.n_required_teams
+        n_reserve = max(0, len(self.heroes) - n_teams * TEAM_SIZE)
+        n_swaps = TEAM_SIZE * TEAM_SIZE * n_teams * (n_teams - 1) // 2 + TEAM_SIZE * n_teams * n_reserve
+        n_solutions = self.n_keep_solutions + self.n_generate_solutions
+        n_rows = (
+            n_teams * (n_solutions + n_swaps + max(n_solutions, n_swaps))
+            + (n_teams + 1) * self.n_generate_solutions
+        )
+        return n_rows * self.hero_features[0].nbytes // 2 ** 20
+
+    def shrink_population(self):
+        """
+        Halves the population until a single enemy search fits into the memory limit.
+        """
+        if self.memory_limit is None:
+            return
+        while self.estimate_memory() > self.memory_limit and self.n_generate_solutions > 1:
+            self.n_keep_solutions = max(1, self.n_keep_solutions // 2)
+            self.n_generate_solutions = max(1, self.n_generate_solutions // 2)
+            logger.warning(
+                'Shrunk population to {} + {} to fit into {} MB.',
+                self.n_keep_solutions,
+                self.n_generate_solutions,
+                self.memory_limit,
+            )
+        if self.estimate_memory() > self.memory_limit:
+            logger.warning('Enemy search needs about {} MB even with the smallest population.', self.estimate_memory())
+
+    def solve_enemies(self, enemies: List[BaseArenaEnemy]) -> List[ArenaSolution]:
+        """
+        Finds solutions for the enemies. The enemies evolve in lockstep,
+        so that there's only one `predict_proba` call per generation.
+        With the memory limit, the enemies are split into the smaller lockstep batches.
+        """
+        if not enemies:
+            return []
+        n_lockstep = len(enemies)
+        if self.memory_limit is not None:
+            n_lockstep = max(1, self.memory_limit // max(1, self.estimate_memory()))
+        solutions: List[ArenaSolution] = []
+        best_solution = None
+        for start in range(0, len(enemies), n_lockstep):
+            best_search, batch_solutions = self.solve_enemies_lockstep(enemies[start:start + n_lockstep])
+            solutions.extend(batch_solutions)
+            # Keep the population of the best enemy to retry it on the next page.
+            if best_solution is None or best_search.solution > best_solution:
+                best_solution = best_search.solution
+                self.solutions = best_search.solutions[best_search.population]
+        return solutions
+
+    def solve_enemies_lockstep(self, enemies: List[BaseArenaEnemy]) -> Tuple[EnemySearch, List[ArenaSolution]]:
+        """
+        Evolves the enemies in lockstep. Returns the best search and the solutions.
+        """
+        logger.debug('Solving arena for {} enemies…', len(enemies))
+
+        # The enemies share the time in lockstep, so the page gets the time budget of all its enemies.
+        deadline = self.deadline
+        if self.enemy_time_budget is not None:
+            page_deadline = monotonic() + self.enemy_time_budget.total_seconds() * len(enemies)
+            deadline = min(deadline, page_deadline) if deadline is not None else page_deadline
+
+        searches = [
+            EnemySearch(self, enemy, self.hero_features, deadline, self.seeds.pop(enemy.user_id, None))
+            for enemy in enemies
+        ]
+
+        # Each prediction call has its overhead, thus call it for all the enemies at once.
+        # The searches write their battles one after another to the buffer, which is allocated once.
+        x = numpy.empty((sum(search.n_max_battles for search in searches), self.hero_features.shape[1]))
+
+        # Let's evolve.
+        while active_searches := [search for search in searches if not search.is_finished]:
+            n_battles = []
+            keys = []
+            for search in active_searches:
+                search_x, search_keys = search.generate(x[sum(n_battles):])
+                n_battles.append(search_x.shape[0])
+                keys.append(search_keys)
+            ys = self.memo.predict(numpy.concatenate(keys), x[:sum(n_battles)], self.predict_proba)
+            for search, y in zip(active_searches, numpy.split(ys, numpy.cumsum(n_battles[:-1]))):
+                search.select(y)
+        logger.debug('{}', self.memo)
+
+        return max(searches, key=attrgetter('solution')), [search.solution for search in searches]
+
+    def predict_proba(self, x: ndarray) -> ndarray:
+        """
+        Predicts the battle win probabilities. All the solver predictions go through here.
+        """
+        self.n_predict_calls += 1
+        self.n_predict_rows += x.shape[0]
+        return self.model.forest.predict_used_proba(x)
+
+    @staticmethod
+    def is_time_up(deadline: Optional[float]) -> bool:
+        return deadline is not None and monotonic() >= deadline
+
+    def get_defenders_key(self, defenders_features: ndarray) -> int:
+        """
+        Gets a small integer which identifies the defenders team in the prediction memo.
+        """
+        return self.defenders_keys.setdefault(defenders_features.tobytes(), len(self.defenders_keys))
+
+    def make_sparse_features(self, team: List[Hero]) -> csr_matrix:
+        """
+        Make team features sparse matrix. Shape is number of heroes × number of model features.
+        Each hero has only a small part of all the features.
+        """
+        return self.vectorizer.transform(team)
+
+    def make_team_features(self, team: List[Hero]) -> ndarray:
+        """
+        Make team features 2D-array. Shape is number of heroes × number of used features.
+        Only the features which are used by the forest are kept, the rest don't affect the predictions.
+        """
+        return self.make_sparse_features(team)[:, self.model.forest.used_features].toarray()
+
+
+class EnemySearch:
+    """
+    Evolution state of a single enemy. Allows evolving multiple enemies in lockstep.
+    """
+
+    def __init__(
+        self,
+        solver: ArenaSolver,
+        enemy: BaseArenaEnemy,
+        hero_features: ndarray,
+        deadline: Optional[float],
+        seeds: Optional[ndarray] = None,
+    ):
         logger.debug('Solving arena for {}…', enemy)
 
-        n_heroes = len(self.heroes)
-        n_actual_teams = len(enemy.teams)  # at first, we will generate the same number of attacker teams
-        n_attackers = n_actual_teams * TEAM_SIZE
+        self.solver = solver
+        self.enemy = enemy
+        self.deadline = deadline
+        self.hero_features = hero_features
+        self.defenders_features = vstack([solver.make_team_features(team).sum(axis=0) for team in enemy.teams])
 
-        hero_features = self.make_team_features(self.heroes)
-        defenders_features = [self.make_team_features(team).sum(axis=0) for team in enemy.teams]
+        n_heroes = len(solver.heroes)
+        self.n_actual_teams = len(enemy.teams)  # at first, we will generate the same number of attacker teams
+        n_attackers = self.n_actual_teams * TEAM_SIZE
 
         # Used to speed up selection of separate attacker teams from the solutions array.
-        team_selectors = slices(n_actual_teams, TEAM_SIZE)
+        self.team_selectors = slices(self.n_actual_teams, TEAM_SIZE)
 
         # Generate all possible (per)mutations of a single solution.
         # We will use it to speed up mutation process by selecting random rows from the `swaps` array.
         # Each permutation swaps two particular elements so that the heroes get interchanged in the teams.
         # In total `n_teams + 1` groups.
         groups = [
-            *[range(selector.start, selector.stop) for selector in team_selectors],
+            *[range(selector.start, selector.stop) for selector in self.team_selectors],
             range(n_attackers, n_heroes),  # fake group to keep there unused heroes
         ]
         logger.trace('{} hero groups.', len(groups))
-        swaps = vstack([
-            swap_permutation(n_heroes, i, j)  # swap these two heroes
+        self.swap_indexes = numpy.array([
+            (i, j)  # swap these two heroes
             for group_1, group_2 in combinations(groups, 2)  # select two groups to interchange heroes in
             for i, j in product(group_1, group_2)  # select particular indexes to interchange
         ])
-        logger.trace('Swaps shape: {}.', swaps.shape)
+        self.swaps = vstack([swap_permutation(n_heroes, i, j) for i, j in self.swap_indexes])
+        logger.trace('Swaps shape: {}.', self.swaps.shape)
 
-        # Let's evolve.
-        count_down = CountDown(count(1), self.n_generations_count_down)
-        solution = ArenaSolution(enemy=enemy, attackers=[], probability=0.0, probabilities=[])
-
-        for n_generation in count_down:
-            # Generate new solutions.
-            # Choose random solutions from the population and apply a random permutation to each of them.
-            new_permutations = swaps[randint(0, swaps.shape[0], self.n_generate_solutions)]
-            new_solutions = self.solutions[
-                choice(self.solutions.shape[0], self.n_generate_solutions).reshape(-1, 1),
-                new_permutations
-            ]
-
-            # Stack old solutions with the new ones.
-            self.solutions = vstack((self.solutions, new_solutions))
-
-            # Predict probabilities.
-            # Call to `predict_proba` is expensive, thus call it for all the teams at once. Stack and split.
-            x = vstack([
-                hero_features[self.solutions[:, selector]].sum(axis=1) - defender_features
-                for selector, defender_features in zip(team_selectors, defenders_features)
+        # Prediction memo key of a battle is the defenders key followed by the sorted attacker indexes.
+        self.defenders_keys = numpy.array([
+            solver.get_defenders_key(defender_features) * n_heroes ** TEAM_SIZE
+            for defender_features in self.defenders_features
+        ])
+        self.key_multipliers = n_heroes ** arange(TEAM_SIZE)
+
+        # Linear surrogate scores of our heroes and of the defenders teams, if the surrogate is to be used.
+        self.hero_scores = solver.hero_scores
+        if self.hero_scores is not None:
+            surrogate = solver.model.surrogate
+            self.defenders_scores = numpy.array([
+                (solver.make_sparse_features(team) @ surrogate.coef).sum() - surrogate.intercept for team in enemy.teams
             ])
-            ys = numpy.split(self.model.estimator.predict_proba(x)[:, 1], n_actual_teams)
-
-            # Convert individual battle probabilities to the final arena battle probabilities.
-            y_reduced = self.reduce_probabilities(*ys)
-
-            # Select top solutions for the next iteration.
-            # See also: https://stackoverflow.com/a/23734295/359730
-            top_indexes = y_reduced.argpartition(-self.n_keep_solutions)[-self.n_keep_solutions:]
-
-            # All the arrays must be cut to the top indexes, otherwise their rows won't correspond to each other.
-            self.solutions = self.solutions[top_indexes, :]
-            y_reduced = y_reduced[top_indexes]
-            ys = [y[top_indexes] for y in ys]
-
-            # Select the best solution of this generation.
-            old_probability = solution.probability
-            max_index = y_reduced.argmax()
-            solution = ArenaSolution(
-                enemy=enemy,
-                attackers=[
-                    [self.heroes[i] for i in self.solutions[max_index, selector]]
-                    for selector in team_selectors
-                ],
-                probability=y_reduced[max_index],
-                probabilities=[y[max_index] for y in ys],
-            )
-            if solution.probability - old_probability >= 0.00001:
-                # The solution has been improved. Give the optimizer another chance to beat it.
-                count_down.reset()
-                logger.trace('Bump: +{:.3f}%.', 100.0 * (solution.probability - old_probability))
-            logger.trace('Generation {:2}: {:.2f}% ({:d})', n_generation, 100.0 * solution.probability, int(count_down))
 
-            # I'm feeling lucky!
-            # It makes sense to stop if the probability is already close to 100%.
-            if solution.probability > 0.99999:
-                break
+        # Team index of each solution position, `-1` for the unused heroes.
+        self.position_teams = numpy.full(n_heroes, -1)
+        for i, selector in enumerate(self.team_selectors):
+            self.position_teams[selector] = i
 
-        return solution
+        # Each enemy starts with the solver population and evolves its own copy.
+        # A part of the population is replaced with the constructive seeds, so the evolution never ends up below them.
+        if seeds is None:
+            [(seeds, _)] = solver.make_seeds([enemy], hero_features)
+        solutions = vstack((seeds, solver.solutions))[:solver.n_keep_solutions]
+
+        # The population and its children live in the buffers which are allocated once and refilled in place.
+        # The population is the rows at `population` indexes, children are written to the rest of the rows.
+        # Team feature sums are kept along with the solutions. Shape is teams × solutions × features.
+        n_solutions = solutions.shape[0] + solver.n_generate_solutions
+        self.population = arange(solutions.shape[0])
+        self.solutions = numpy.zeros((n_solutions, n_heroes), dtype=solutions.dtype)
+        self.solutions[self.population] = solutions
+        self.team_features = numpy.zeros((self.n_actual_teams, n_solutions, hero_features.shape[1]))
+        for team_features, selector in zip(self.team_features, self.team_selectors):
+            team_features[self.population] = hero_features[solutions[:, selector]].sum(axis=1)
+
+        # Maximal number of the battles in a single generation, either evolution or polishing one.
+        self.n_max_battles = self.n_actual_teams * max(n_solutions, self.swaps.shape[0])
 
-    def make_hero_features(self, hero: Hero) -> ndarray:
+        self.count_down = CountDown(count(1), solver.n_generations_count_down)
+        self.n_generation = self.n_best_generation = 0
+        self.is_finished = False
+        self.solution = ArenaSolution(enemy=enemy, attackers=[], probability=0.0, probabilities=[])
+        self.best_index = 0  # index of the best solution in the population
+
+        # After the evolution, the best solution gets polished with the steepest-ascent local search.
+        self.is_polishing = False
+        self.neighbours = self.neighbours_features = numpy.array([])
+
+    def generate(self, out: Optional[ndarray] = None) -> Tuple[ndarray, ndarray]:
         """
-        Make hero features 1D-array.
+        Generates new solutions and returns features and memo keys of the battles to predict.
+        The individual battles are stacked, thus the result has `n_actual_teams` times more rows.
+        The features are written to `out`, if given. It must have at least `n_max_battles` rows.
         """
-        return numpy.fromiter((hero.features.get(name, 0.0) for name in self.model.feature_names), numpy.float)
+        if self.is_polishing:
+            # Evaluate the entire swap neighbourhood of the best solution.
+            n_swaps = self.swaps.shape[0]
+            self.neighbours, self.neighbours_features = self.make_children(
+                numpy.full(n_swaps, self.best_index), arange(n_swaps))
+            return self.make_battles(self.neighbours, self.neighbours_features, out)
 
-    def make_team_features(self, team: List[Hero]) -> ndarray:
+        # Choose random solutions from the population and apply a random permutation to each of them.
+        # With the surrogate, more children are generated, and only the most promising ones go to the model.
+        n_generate_solutions = self.solver.n_generate_solutions
+        n_candidates = n_generate_solutions * (self.solver.surrogate_factor if self.hero_scores is not None else 1)
+        parents = self.population[choice(self.population.shape[0], n_candidates)]
+        swap_indexes = randint(0, self.swaps.shape[0], n_candidates)
+        if self.hero_scores is not None:
+            parents, swap_indexes = self.screen_children(parents, swap_indexes, n_generate_solutions)
+
+        # The children take the places of the solutions which have dropped out of the population.
+        is_child = numpy.ones(self.solutions.shape[0], dtype=bool)
+        is_child[self.population] = False
+        children = numpy.flatnonzero(is_child)
+        self.solutions[children], self.team_features[:, children] = self.make_children(parents, swap_indexes)
+
+        return self.make_battles(self.solutions, self.team_features, out)
+
+    def make_children(self, parents: ndarray, swap_indexes: ndarray) -> Tuple[ndarray, ndarray]:
         """
-        Make team features 2D-array. Shape is number of heroes × number of features.
+        Applies the swaps to the parent solutions. Returns the children solutions and their team features.
         """
-        return vstack([self.make_hero_features(hero) for hero in team])
+        solutions = self.solutions[parents.reshape(-1, 1), self.swaps[swap_indexes]]
+
+        # A child differs from its parent by the only swap. Thus, instead of summing up the entire teams,
+        # subtract the outgoing hero features and add the incoming ones. The features are integer,
+        # so the sums stay exact.
+        i, j = self.swap_indexes[swap_indexes].T
+        delta = self.hero_features[self.solutions[parents, j]] - self.hero_features[self.solutions[parents, i]]
+        team_features = self.team_features[:, parents]
+        for team, features in enumerate(team_features):
+            features[self.position_teams[i] == team] += delta[self.position_teams[i] == team]
+            features[self.position_teams[j] == team] -= delta[self.position_teams[j] == team]
+
+        return solutions, team_features
+
+    def screen_children(self, parents: ndarray, swap_indexes: ndarray, n_children: int) -> Tuple[ndarray, ndarray]:
+        """
+        Ranks the children with the linear surrogate and returns parents and swaps of the top ones.
+        A linear team score is the sum of the hero scores, thus the children are scored by the swaps as well.
+        """
+        i, j = self.swap_indexes[swap_indexes].T
+        delta = self.hero_scores[self.solutions[parents, j]] - self.hero_scores[self.solutions[parents, i]]
+        logits = numpy.stack([
+            self.hero_scores[self.solutions[parents, selector]].sum(axis=1) for selector in self.team_selectors
+        ])
+        for team, team_logits in enumerate(logits):
+            team_logits[self.position_teams[i] == team] += delta[self.position_teams[i] == team]
+            team_logits[self.position_teams[j] == team] -= delta[self.position_teams[j] == team]
+        y = self.solver.reduce_probabilities(*expit(logits - self.defenders_scores[:, numpy.newaxis]))
+        top_indexes = y.argpartition(-n_children)[-n_children:]
+        return parents[top_indexes], swap_indexes[top_indexes]
+
+    def make_battles(
+        self,
+        solutions: ndarray,
+        team_features: ndarray,
+        out: Optional[ndarray] = None,
+    ) -> Tuple[ndarray, ndarray]:
+        """
+        Makes features and memo keys of the individual battles. Battles are stacked team by team.
+        """
+        if out is not None:
+            out = out[:team_features.shape[0] * team_features.shape[1]].reshape(team_features.shape)
+        x = numpy.subtract(team_features, self.defenders_features[:, numpy.newaxis, :], out=out)
+        keys = numpy.concatenate([
+            numpy.sort(solutions[:, selector], axis=1) @ self.key_multipliers + defenders_key
+            for selector, defenders_key in zip(self.team_selectors, self.defenders_keys)
+        ])
+        return x.reshape(-1, x.shape[-1]), keys
+
+    def select(self, y: ndarray):
+        """
+        Selects the best solutions given the predicted probabilities of the individual battles.
+        """
+        if self.is_polishing:
+            self.select_neighbour(y)
+            return
+
+        self.n_generation = next(self.count_down)
+        n_keep_solutions = self.solver.n_keep_solutions
+        ys = numpy.split(y, self.n_actual_teams)
+
+        # Convert individual battle probabilities to the final arena battle probabilities.
+        y_reduced = self.solver.reduce_probabilities(*ys)
+
+        # Select top solutions for the next iteration. The rows stay in place, only their indexes are kept.
+        # See also: https://stackoverflow.com/a/23734295/359730
+        self.population = y_reduced.argpartition(-n_keep_solutions)[-n_keep_solutions:]
+
+        # Select the best solution of this generation.
+        self.best_index = self.population[y_reduced[self.population].argmax()]
+        if y_reduced[self.best_index] - self.solution.probability >= 0.00001:
+            # The solution has been improved. Give the optimizer another chance to beat it.
+            self.count_down.reset()
+            self.n_best_generation = self.n_generation
+            logger.trace('Bump: +{:.3f}%.', 100.0 * (y_reduced[self.best_index] - self.solution.probability))
+        self.solution = self.make_solution(self.solutions[self.best_index], [y[self.best_index] for y in ys])
+        logger.trace(
+            'Generation {:2}: {:.2f}% ({:d})',
+            self.n_generation,
+            100.0 * self.solution.probability,
+            int(self.count_down),
+        )
+
+        # I'm feeling lucky!
+        # It makes sense to stop if the probability is already close to 100%.
+        if self.solution.probability > 0.99999:
+            self.is_finished = True
+        # Anytime mode: just take the best solution so far when the time is up.
+        elif self.solver.is_time_up(self.deadline):
+            logger.debug('Time is up for {} at generation {}.', self.enemy, self.n_generation)
+            self.is_finished = True
+        # When the solution stays the best for enough generations, polish it with the local search.
+        elif not int(self.count_down):
+            self.is_polishing = True
+
+    def select_neighbour(self, y: ndarray):
+        """
+        Moves to the best neighbour of the best solution, if it's better. Otherwise, the local optimum is reached.
+        """
+        self.n_generation += 1
+        ys = numpy.split(y, self.n_actual_teams)
+        y_reduced = self.solver.reduce_probabilities(*ys)
+        index = y_reduced.argmax()
+        if y_reduced[index] - self.solution.probability < 0.00001:
+            logger.trace('Local optimum: {:.2f}%.', 100.0 * self.solution.probability)
+            self.is_finished = True
+            return
+
+        logger.trace('Polish: +{:.3f}%.', 100.0 * (y_reduced[index] - self.solution.probability))
+        self.n_best_generation = self.n_generation
+        self.solutions[self.best_index] = self.neighbours[index]
+        self.team_features[:, self.best_index] = self.neighbours_features[:, index]
+        self.solution = self.make_solution(self.neighbours[index], [y[index] for y in ys])
+        if self.solver.is_time_up(self.deadline):
+            logger.debug('Time is up for {} while polishing.', self.enemy)
+            self.is_finished = True
+
+    def make_solution(self, solution: ndarray, probabilities: List[float]) -> ArenaSolution:
+        return ArenaSolution(
+            enemy=self.enemy,
+            attackers=[self.solver.heroes.take(solution[selector]) for selector in self.team_selectors],
+            probability=self.solver.reduce_probabilities(*(numpy.array([y]) for y in probabilities))[0],
+            probabilities=probabilities,
+            n_generations=self.n_best_generation,
+        )
+
+
+class PredictionMemo:
+    """
+    Bounded LRU memo of battle win probabilities. Only unseen battles get to the model.
+    """
+
+    def __init__(self, max_size: int, chunk_size: int):
+        self.max_size = max_size
+        self.chunk_size = chunk_size  # rows are copied and predicted in chunks to bound the temporary memory
+        self.probabilities: OrderedDict[int, float] = OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def predict(self, keys: ndarray, x: ndarray, predict_proba: Callable[[ndarray], ndarray]) -> ndarray:
+        y = numpy.empty(keys.shape[0])
+        is_missing = numpy.ones(keys.shape[0], dtype=bool)
+        for i, key in enumerate(keys.tolist()):
+            probability = self.probabilities.get(key)
+            if probability is not None:
+                self.probabilities.move_to_end(key)
+                y[i] = probability
+                is_missing[i] = False
+
+        # The same battle may appear multiple times in a batch, predict it only once.
+        missing_keys, unique_indexes, inverse_indexes = numpy.unique(
+            keys[is_missing], return_index=True, return_inverse=True)
+        if missing_keys.size:
+            rows = numpy.flatnonzero(is_missing)[unique_indexes]
+            missing_y = numpy.concatenate([
+                predict_proba(x[rows[start:start + self.chunk_size]])
+                for start in range(0, rows.shape[0], self.chunk_size)
+            ])
+            y[is_missing] = missing_y[inverse_indexes]
+            self.probabilities.update(zip(missing_keys.tolist(), missing_y.tolist()))
+            while len(self.probabilities) > self.max_size:
+                self.probabilities.popitem(last=False)
+
+        self.n_hits += keys.shape[0] - missing_keys.shape[0]
+        self.n_misses += missing_keys.shape[0]
+        return y
+
+    def __str__(self) -> str:
+        n_total = self.n_hits + self.n_misses
+        return f'Prediction memo: {self.n_hits} hits of {n_total} ({100.0 * self.n_hits / (n_total or 1):.1f}%).'
+
+
+# Parallel solving.
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Solver of the current worker process. The model is passed only once, when the process starts.
+worker_solver: Optional[ArenaSolver] = None
+
+
+def initialize_worker(solutions: ndarray, kwargs: Dict[str, Any]):
+    global worker_solver
+    worker_solver = ArenaSolver(
+        db={},
+        user_clan_id=None,
+        max_iterations=1,
+        get_enemies=list,
+        friendly_clans=[],
+        callback=lambda n_page: None,
+        **kwargs,
+    )
+    worker_solver.solutions = solutions
+
+
+def solve_enemy_in_worker(
+    enemy: BaseArenaEnemy,
+    deadline: Optional[float],
+    seeds: Optional[ndarray],
+) -> Tuple[ArenaSolution, ndarray]:
+    """
+    Solves the enemy in the worker process. Returns the solution along with the final population.
+    """
+    # Monotonic clock is shared by all the processes, thus the search deadline is valid here as well.
+    worker_solver.deadline = deadline
+    if seeds is not None:
+        worker_solver.seeds[enemy.user_id] = seeds
+    return worker_solver.solve_enemy(enemy), worker_solver.solutions
 
 
 # Utilities.
@@ -325,18 +1005,19 @@ def swap_permutation(size: int, index_1: int, index_2: int) -> ndarray:
     return permutation
 
 
-def reduce_normal_arena(y: ndarray) -> ndarray:
+def reduce_at_least(k: int, *ys: ndarray) -> ndarray:
     """
+    Gives probability to win at least `k` of the battles with the independent win probabilities `ys`.
     For the normal one-battle arena it's just the probabilities themselves.
     """
-    return y
-
-
-def reduce_grand_arena(y1: ndarray, y2: ndarray, y3: ndarray) -> ndarray:
-    """
-    Gives probability to win at least two of three battles.
-    """
-    return y1 * y2 * y3 + y1 * y2 * (1.0 - y3) + y2 * y3 * (1.0 - y1) + y1 * y3 * (1.0 - y2)
+    # Probabilities to win exactly `0, 1, …, k - 1` battles so far. The last row accumulates `k` and more wins.
+    p = numpy.zeros((k + 1, *numpy.shape(ys[0])))
+    p[0] = 1.0
+    for y in ys:
+        won = p[:-1] * y
+        p[:-1] *= 1.0 - y
+        p[1:] += won
+    return p[k]
 
 
 # Tester.
@@ -350,7 +1031,7 @@ def main(verbosity: int):
 
     logger.info('Loading the dumps…')
     with Database(constants.DATABASE_NAME) as db:
-        model: Model = pickle.loads(b85decode(db['bot:model']))
+        model = Model.loads(db['bot:model'])
     heroes: List[Hero] = pickle.loads((Path('dumps') / 'heroes.pkl').read_bytes())
     arena_enemies: List[ArenaEnemy] = pickle.loads((Path('dumps') / 'arena_enemies.pkl').read_bytes())
     grand_enemies: List[GrandArenaEnemy] = pickle.loads((Path('dumps') / 'grand_enemies.pkl').read_bytes())
@@ -370,7 +1051,6 @@ def main(verbosity: int):
             early_stop=0.95,
             get_enemies=list,
             friendly_clans=[],
-            reduce_probabilities=reduce_normal_arena,
             callback=lambda: None,
         ).initialize().solve_enemy(enemy)
         logger.info('{}', solution)
@@ -390,7 +1070,6 @@ def main(verbosity: int):
             early_stop=0.95,
             get_enemies=list,
             friendly_clans=[],
-            reduce_probabilities=reduce_grand_arena,
             callback=lambda: None,
         ).initialize().solve_enemy(enemy)
         logger.info('{}', solution)
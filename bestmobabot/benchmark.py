@@ -0,0 +1,189 @@
+"""
+Reproducible arena solver benchmark on the pre-dumped data.
+"""
+
+from __future__ import annotations
+
+import json
+import pickle
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import click
+import numpy
+from loguru import logger
+
+import bestmobabot.logging_
+from bestmobabot import constants
+from bestmobabot.arena import ArenaSolver
+from bestmobabot.database import Database
+from bestmobabot.dataclasses_ import BaseArenaEnemy, Hero
+from bestmobabot.model import Model
+from bestmobabot.settings import ArenaSettings
+
+
+def make_solver(model: Model, heroes: List[Hero], n_required_teams: int) -> ArenaSolver:
+    """
+    Makes solver with the default settings.
+    """
+    settings = ArenaSettings()
+    prefix = 'normal' if n_required_teams == 1 else 'grand'
+    return ArenaSolver(
+        db={},
+        model=model,
+        user_clan_id=None,
+        heroes=heroes,
+        n_required_teams=n_required_teams,
+        max_iterations=1,
+        n_keep_solutions=getattr(settings, f'{prefix}_keep_solutions'),
+        n_generate_solutions=getattr(settings, f'{prefix}_generate_solutions'),
+        n_generations_count_down=getattr(settings, f'{prefix}_generations_count_down'),
+        early_stop=settings.early_stop,
+        get_enemies=list,
+        friendly_clans=[],
+        callback=lambda n_page: None,
+        surrogate_factor=settings.surrogate_factor,
+        memory_limit=settings.solver_memory_limit,
+    ).initialize()
+
+
+def run_enemy(
+    model: Model,
+    heroes: List[Hero],
+    n_required_teams: int,
+    enemy: BaseArenaEnemy,
+    seed: int,
+) -> Tuple[ArenaSolver, Any, float]:
+    numpy.random.seed(seed)
+    solver = make_solver(model, heroes, n_required_teams)
+    start_time = perf_counter()
+    solution = solver.solve_enemy(enemy)
+    return solver, solution, perf_counter() - start_time
+
+
+def benchmark(
+    model: Model,
+    heroes: List[Hero],
+    enemies: Iterable[Tuple[str, int, BaseArenaEnemy]],
+    seed: int,
+    trace_memory: bool,
+) -> Iterable[Dict[str, Any]]:
+    for arena, n_required_teams, enemy in enemies:
+        logger.info('Solving {} arena for {}…', arena, enemy)
+        solver, solution, time = run_enemy(model, heroes, n_required_teams, enemy, seed)
+
+        # Memory tracing slows down the solver, thus it's measured in a separate run with the same seed.
+        peak_memory: Optional[int] = None
+        if trace_memory:
+            tracemalloc.start()
+            run_enemy(model, heroes, n_required_teams, enemy, seed)
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        result = {
+            'arena': arena,
+            'user_id': enemy.user_id,
+            'time': time,
+            'n_generations': solution.n_generations,
+            'n_predict_calls': solver.n_predict_calls,
+            'n_predict_rows': solver.n_predict_rows,
+            'peak_memory': peak_memory,
+            'probability': float(solution.probability),
+        }
+        logger.success(
+            '{}: {:.2f}s, {} generations, {} calls, {} rows, {:.1f}%.',
+            solution.enemy,
+            time,
+            solution.n_generations,
+            solver.n_predict_calls,
+            solver.n_predict_rows,
+            100.0 * solution.probability,
+        )
+        yield result
+
+
+def compare(
+    baseline: List[Dict[str, Any]],
+    results: List[Dict[str, Any]],
+    max_slowdown: float,
+    max_probability_loss: float,
+) -> bool:
+    """
+    Compares the results with the baseline ones. Returns `False` if there's a regression.
+    """
+    baseline_results = {(result['arena'], result['user_id']): result for result in baseline}
+    is_ok = True
+    for result in results:
+        baseline_result = baseline_results.get((result['arena'], result['user_id']))
+        if baseline_result is None:
+            logger.warning('No baseline for {} arena enemy #{}.', result['arena'], result['user_id'])
+            continue
+        speed_up = baseline_result['time'] / result['time']
+        probability_delta = result['probability'] - baseline_result['probability']
+        is_regression = speed_up < 1.0 / max_slowdown or probability_delta < -max_probability_loss
+        (logger.error if is_regression else logger.info)(
+            '{} arena enemy #{}: ×{:.2f} speed, {:+.2f}% probability, {:+d} rows.',
+            result['arena'],
+            result['user_id'],
+            speed_up,
+            100.0 * probability_delta,
+            result['n_predict_rows'] - baseline_result['n_predict_rows'],
+        )
+        is_ok &= not is_regression
+    return is_ok
+
+
+@click.command()
+@click.option('verbosity', '-v', '--verbose', count=True, help='Increase verbosity.')
+@click.option('--seed', type=int, default=42, help='Random seed.', show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to the JSON file.')
+@click.option('--baseline', type=click.File(), help='Compare the results with the JSON file.')
+@click.option('--max-slowdown', type=float, default=1.2, help='Maximal allowed slowdown.', show_default=True)
+@click.option(
+    '--max-probability-loss',
+    type=float,
+    default=0.01,
+    help='Maximal allowed win probability loss.',
+    show_default=True,
+)
+@click.option('--trace-memory/--no-trace-memory', default=True, help='Measure peak memory.', show_default=True)
+def main(
+    verbosity: int,
+    seed: int,
+    output: Optional[str],
+    baseline: Optional[Any],
+    max_slowdown: float,
+    max_probability_loss: float,
+    trace_memory: bool,
+):
+    """
+    Benchmark the arena solver on the pre-dumped data.
+    """
+    bestmobabot.logging_.install_logging(verbosity)
+
+    logger.info('Loading the dumps…')
+    with Database(constants.DATABASE_NAME) as db:
+        model = Model.loads(db['bot:model'])
+    heroes: List[Hero] = pickle.loads((Path('dumps') / 'heroes.pkl').read_bytes())
+    enemies = [
+        *(('normal', 1, enemy) for enemy in pickle.loads((Path('dumps') / 'arena_enemies.pkl').read_bytes())),
+        *(
+            ('grand', constants.N_GRAND_TEAMS, enemy)
+            for enemy in pickle.loads((Path('dumps') / 'grand_enemies.pkl').read_bytes())
+        ),
+    ]
+
+    results = list(benchmark(model, heroes, enemies, seed, trace_memory))
+    logger.info('Total time: {:.2f}s.', sum(result['time'] for result in results))
+
+    if output:
+        Path(output).write_text(json.dumps({'seed': seed, 'results': results}, indent=2))
+    if baseline and not compare(json.load(baseline)['results'], results, max_slowdown, max_probability_loss):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
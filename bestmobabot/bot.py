@@ -1,6 +1,4 @@
 import calendar
-import pickle
-from base64 import b85decode
 from datetime import datetime, time, timedelta, timezone
 from operator import attrgetter
 from random import choice, shuffle
@@ -9,13 +7,14 @@ from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 from bestmobabot import constants
 from bestmobabot.api import API, AlreadyError, NotEnoughError, NotFoundError
-from bestmobabot.arena import ArenaSolution, ArenaSolver, reduce_grand_arena, reduce_normal_arena
+from bestmobabot.arena import ArenaSolution, ArenaSolver
 from bestmobabot.database import Database
 from bestmobabot.dataclasses_ import ArenaResult, Hero, Mission, Quest, Quests, Replay, User
 from bestmobabot.enums import BattleType, TowerFloorType
+from bestmobabot.features import HeroTable
 from bestmobabot.helpers import find_expedition_team, get_teams_unit_ids, get_unit_ids, naive_select_attackers
 from bestmobabot.logging_ import log_rewards, logger
-from bestmobabot.model import Model
+from bestmobabot.model import BattleStore, Model
 from bestmobabot.resources import get_heroic_mission_ids, mission_name, shop_name
 from bestmobabot.scheduler import Scheduler, Task, now
 from bestmobabot.settings import Settings
@@ -226,7 +225,7 @@ class Bot:
         # Select available heroes.
         busy_ids = {hero_id for expedition in started_expeditions for hero_id in expedition.hero_ids}
         logger.info('Busy heroes: {}.', busy_ids)
-        heroes: Dict[str, Hero] = {hero.id: hero for hero in self.api.get_all_heroes() if hero.id not in busy_ids}
+        heroes = HeroTable(hero for hero in self.api.get_all_heroes() if hero.id not in busy_ids)
         logger.info('{} heroes are still available.', len(heroes))
 
         # Let's see which expeditions are available.
@@ -239,7 +238,7 @@ class Bot:
             logger.info('The optimal expedition power is {}.', expedition.power)
 
             # Choose the least powerful appropriate team.
-            team = find_expedition_team(heroes.values(), expedition.power)
+            team = find_expedition_team(heroes, expedition.power)
             if team is None:
                 logger.info('Could not find powerful enough team.')
                 break
@@ -250,8 +249,8 @@ class Bot:
             self.farm_quests(quests)
 
             # Exclude the busy heroes.
-            for hero in team:
-                del heroes[hero.id]
+            team_ids = set(get_unit_ids(team))
+            heroes = HeroTable(hero for hero in heroes if hero.id not in team_ids)
 
             # We should farm the earliest finished expedition.
             if next_run_at is None or end_time < next_run_at:
@@ -325,6 +324,7 @@ class Bot:
             self.db,
             n_splits=constants.MODEL_N_SPLITS,
             n_last_battles=self.settings.bot.arena.last_battles,
+            n_processes=self.settings.bot.arena.trainer_processes,
         ).train()
         self.log(f'🎲️ *{self.user.name}* натренировал модель.')
 
@@ -341,7 +341,7 @@ class Bot:
         # Load arena model.
         logger.info('Loading model…')
         try:
-            model: Model = pickle.loads(b85decode(self.db['bot:model']))
+            model = Model.loads(self.db['bot:model'])
         except KeyError:
             logger.warning('Model is not ready yet.')
             return
@@ -358,6 +358,10 @@ class Bot:
 
         # Pick an enemy and select attackers.
         solution = make_solver(model, heroes).solve()
+        if solution is None:
+            logger.warning('No suitable enemies.')
+            self.log(f'⚔️ *{self.user.name}* не нашел противников.')
+            return now() + constants.ARENA_RETRY_INTERVAL
         with self.logger:
             self.logger.append(f'⚔️ *{self.user.name}* атакует арену:', '')
             solution.log(self.logger)
@@ -394,11 +398,17 @@ class Bot:
                 n_keep_solutions=self.settings.bot.arena.normal_keep_solutions,
                 n_generate_solutions=self.settings.bot.arena.normal_generate_solutions,
                 n_generations_count_down=self.settings.bot.arena.normal_generations_count_down,
+                enemy_time_budget=self.settings.bot.arena.normal_enemy_time_budget,
+                time_budget=self.settings.bot.arena.normal_time_budget,
                 early_stop=self.settings.bot.arena.early_stop,
                 get_enemies=self.api.find_arena_enemies,
                 friendly_clans=self.settings.bot.arena.friendly_clans,
-                reduce_probabilities=reduce_normal_arena,
                 callback=lambda i: self.log(f'⚔️ *{self.user.name}* на странице *{i}* обычной арены…'),
+                n_processes=self.settings.bot.arena.solver_processes,
+                user_id=self.user.id,
+                solution_ttl=self.settings.bot.arena.solution_ttl,
+                surrogate_factor=self.settings.bot.arena.surrogate_factor,
+                memory_limit=self.settings.bot.arena.solver_memory_limit,
             ),
             attack=lambda solution: self.api.attack_arena(solution.enemy.user_id, get_unit_ids(solution.attackers[0])),
             finalise=lambda: None,
@@ -421,11 +431,17 @@ class Bot:
                 n_keep_solutions=self.settings.bot.arena.grand_keep_solutions,
                 n_generate_solutions=self.settings.bot.arena.grand_generate_solutions,
                 n_generations_count_down=self.settings.bot.arena.grand_generations_count_down,
+                enemy_time_budget=self.settings.bot.arena.grand_enemy_time_budget,
+                time_budget=self.settings.bot.arena.grand_time_budget,
                 early_stop=self.settings.bot.arena.early_stop,
                 get_enemies=self.api.find_grand_enemies,
                 friendly_clans=self.settings.bot.arena.friendly_clans,
-                reduce_probabilities=reduce_grand_arena,
                 callback=lambda i: self.log(f'⚔️ *{self.user.name}* на странице *{i}* гранд-арены…'),
+                n_processes=self.settings.bot.arena.solver_processes,
+                user_id=self.user.id,
+                solution_ttl=self.settings.bot.arena.solution_ttl,
+                surrogate_factor=self.settings.bot.arena.surrogate_factor,
+                memory_limit=self.settings.bot.arena.solver_memory_limit,
             ),
             attack=lambda solution: self.api.attack_grand(
                 solution.enemy.user_id, get_teams_unit_ids(solution.attackers)),
@@ -442,17 +458,23 @@ class Bot:
             *self.api.get_battle_by_type(BattleType.ARENA),
             *self.api.get_battle_by_type(BattleType.GRAND),
         ]
+        new_replays: List[Tuple[str, Dict[str, Any]]] = []
         for replay in replays:
             if f'replays:{replay.id}' in self.db:
                 continue
-            self.db[f'replays:{replay.id}'] = {
+            value = self.db[f'replays:{replay.id}'] = {
                 'start_time': replay.start_time.timestamp(),
                 'win': replay.result.win,
                 'attackers': [hero.dict() for hero in replay.attackers.values()],
                 'defenders': [hero.dict() for defenders in replay.defenders for hero in defenders.values()],
             }
+            new_replays.append((replay.id, value))
             logger.info(f'Saved #{replay.id}.')
 
+        # Parse the new battles right away, so that the training doesn't have to.
+        if new_replays:
+            BattleStore(self.db).add(new_replays)
+
         self.log(f'📒️ *{self.user.name}* прочитал журнал арены.')
 
     def check_freebie(self):
@@ -672,7 +694,7 @@ class Bot:
         """
         self.log(f'🎲️ *{self.user.name}* изменяет защитников арены…')
 
-        heroes = naive_select_attackers(self.api.get_all_heroes(), count=constants.N_GRAND_HEROES)
+        heroes = naive_select_attackers(HeroTable(self.api.get_all_heroes()), count=constants.N_GRAND_HEROES)
         if len(heroes) < constants.N_GRAND_HEROES:
             return
         hero_ids = get_unit_ids(heroes)
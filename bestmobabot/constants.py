@@ -17,6 +17,9 @@ TEAM_SIZE = 5  # heroes
 N_GRAND_TEAMS = 3
 N_GRAND_HEROES = N_GRAND_TEAMS * TEAM_SIZE  # heroes
 
+# Expeditions control.
+EXPEDITION_TEAMS_CHUNK_SIZE = 65536  # team combinations to sum up the power of at once
+
 # Chests control.
 MAX_OPEN_ARTIFACT_CHESTS = 10
 
@@ -30,8 +33,17 @@ MODEL_N_SPLITS = 5
 MODEL_N_ESTIMATORS_CHOICES = [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 70, 80, 90, 100]
 MODEL_PARAM_GRID = {
     'n_estimators': MODEL_N_ESTIMATORS_CHOICES,
+    'max_depth': [None, 20],
+    'max_features': ['sqrt', 'log2'],
+    'min_samples_leaf': [1, 3],
 }
 MODEL_N_LAST_BATTLES = 20000
+MODEL_BATTLES_CHUNK_SIZE = 1000  # parsed battles stored in a single database entry
+
+# Arena solver.
+ARENA_PREDICTION_MEMO_SIZE = 100000  # battles
+ARENA_PREDICTION_CHUNK_MEMORY = 16 * 2 ** 20  # bytes of battle features to predict at once
+ARENA_SCREENING_MARGIN = 0.2  # maximal expected improvement of the seed solutions by the evolution
 
 # Arena retries.
 ARENA_MIN_PROBABILITY = 0.5
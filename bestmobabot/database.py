@@ -4,8 +4,9 @@ Database wrapper.
 
 import json
 import sqlite3
+import threading
 from contextlib import AbstractContextManager, closing
-from typing import Any, Iterable, Iterator, MutableMapping, Tuple, TypeVar
+from typing import Any, Iterable, Iterator, List, MutableMapping, Tuple, TypeVar
 
 from loguru import logger
 
@@ -14,8 +15,10 @@ T = TypeVar('T')
 
 class Database(AbstractContextManager, MutableMapping[str, Any]):
     def __init__(self, path: str):
-        self.connection = sqlite3.connect(path, isolation_level=None)
-        with closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+        # The connection is shared with the background threads, e.g. the arena enemies prefetching.
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS `default` (
                     `key` TEXT PRIMARY KEY NOT NULL,
@@ -28,22 +31,30 @@ class Database(AbstractContextManager, MutableMapping[str, Any]):
         """
         Gets all values from the specified index.
         """
-        with closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
             cursor.execute("SELECT `key`, `value` FROM `default` WHERE `key` LIKE ? || '%'", (prefix,))
             return ((key, json.loads(value)) for key, value in cursor.fetchall())
 
+    def get_keys_by_prefix(self, prefix: str) -> List[str]:
+        """
+        Gets all keys from the specified index without reading the values.
+        """
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+            cursor.execute("SELECT `key` FROM `default` WHERE `key` LIKE ? || '%'", (prefix,))
+            return [key for key, in cursor.fetchall()]
+
     def vacuum(self):
-        with closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
             cursor.execute('VACUUM')
 
     def __contains__(self, key: str) -> bool:
-        with closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
             cursor.execute('SELECT exists(SELECT 1 FROM `default` WHERE `key` = ?)', (key,))
             return bool(cursor.fetchone()[0])
 
     def __getitem__(self, key: str) -> Any:
         logger.trace('get {}', key)
-        with closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
             cursor.execute('SELECT value FROM `default` WHERE `key` = ?', (key,))
             if row := cursor.fetchone():
                 return json.loads(row[0])
@@ -51,7 +62,7 @@ class Database(AbstractContextManager, MutableMapping[str, Any]):
 
     def __setitem__(self, key: str, value: Any) -> None:
         logger.trace('set {} = {!s:.40}…', key, value)
-        with closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
             cursor.execute('''
                 INSERT OR REPLACE INTO `default` (`key`, `value`)
                 VALUES (?, ?)
@@ -61,10 +72,15 @@ class Database(AbstractContextManager, MutableMapping[str, Any]):
         raise NotImplementedError()
 
     def __delitem__(self, key: str) -> None:
-        raise NotImplementedError()
+        logger.trace('delete {}', key)
+        with self.lock, closing(self.connection.cursor()) as cursor:  # type: sqlite3.Cursor
+            cursor.execute('DELETE FROM `default` WHERE `key` = ?', (key,))
+            if not cursor.rowcount:
+                raise KeyError(key)
 
     def __iter__(self) -> Iterator[str]:
         raise NotImplementedError()
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.connection.__exit__(exc_type, exc_value, traceback)
+        with self.lock:
+            self.connection.__exit__(exc_type, exc_value, traceback)
@@ -213,36 +213,6 @@ class Hero(Unit):
     def fix_skins(cls, value):
         return value or {}  # 🤦‍
 
-    @property
-    def features(self) -> Dict[str, float]:
-        return {
-            'total_color_level': float(self.color) * float(self.level),
-            'total_color_level_star': float(self.color) * float(self.level) * float(self.star),
-            'total_color_star': float(self.color) * float(self.star),
-            'total_colors': float(self.color),
-            'total_colors2': float(self.color ** 2),
-            'total_heroes': 1.0,
-            'total_level_star': float(self.level) * float(self.star),
-            'total_levels': float(self.level),
-            'total_levels2': float(self.level ** 2),
-            'total_stars': float(self.star),
-            'total_stars2': float(self.star ** 2),
-            **{f'artifact_level_{self.id}_{i}': artifact['level'] for i, artifact in enumerate(self.artifacts)},
-            **{f'artifact_star_{self.id}_{i}': artifact['star'] for i, artifact in enumerate(self.artifacts)},
-            **{f'rune_{self.id}_{i}': float(level) for i, level in enumerate(self.runes)},
-            **{f'skill_{self.id}_{skill_id}': float(level) for skill_id, level in self.skills.items()},
-            **{f'slot_{self.id}_{n_slot}': 1.0 for n_slot in self.slots},
-            f'color_level_star_{self.id}': float(self.color) * float(self.level) * float(self.star),
-            f'color_level_{self.id}': float(self.color) * float(self.level),
-            f'color_star_{self.id}': float(self.color) * float(self.star),
-            f'color_{self.id}': float(self.color),
-            f'level_star_{self.id}': float(self.level) * float(self.star),
-            f'level_{self.id}': float(self.level),
-            f'skin_{self.id}': float(self.skin_level),
-            f'star_{self.id}': float(self.star),
-            f'titan_gift_level_{self.id}': float(self.titan_gift_level or 0.0),
-        }
-
     @property
     def skin_level(self) -> int:
         return self.skins.get(self.current_skin, 0)
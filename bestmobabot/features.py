@@ -0,0 +1,214 @@
+"""
+Hero feature vectorization and the hero roster table.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy
+from scipy.sparse import csr_matrix
+
+from bestmobabot.dataclasses_ import Hero
+
+# Version of the features. Bump it on any change of the features, so that the stored battles get parsed again.
+FEATURES_VERSION = 1
+
+# Features which are shared by all the heroes: names and how they're computed.
+TOTAL_FEATURES: Tuple[Tuple[str, Callable[[Hero], float]], ...] = (
+    ('total_color_level', lambda hero: float(hero.color) * float(hero.level)),
+    ('total_color_level_star', lambda hero: float(hero.color) * float(hero.level) * float(hero.star)),
+    ('total_color_star', lambda hero: float(hero.color) * float(hero.star)),
+    ('total_colors', lambda hero: float(hero.color)),
+    ('total_colors2', lambda hero: float(hero.color ** 2)),
+    ('total_heroes', lambda hero: 1.0),
+    ('total_level_star', lambda hero: float(hero.level) * float(hero.star)),
+    ('total_levels', lambda hero: float(hero.level)),
+    ('total_levels2', lambda hero: float(hero.level ** 2)),
+    ('total_stars', lambda hero: float(hero.star)),
+    ('total_stars2', lambda hero: float(hero.star ** 2)),
+)
+
+# Features of the particular hero. The name is followed by the hero ID.
+HERO_FEATURES: Tuple[Tuple[str, Callable[[Hero], float]], ...] = (
+    ('color_level_star', lambda hero: float(hero.color) * float(hero.level) * float(hero.star)),
+    ('color_level', lambda hero: float(hero.color) * float(hero.level)),
+    ('color_star', lambda hero: float(hero.color) * float(hero.star)),
+    ('color', lambda hero: float(hero.color)),
+    ('level_star', lambda hero: float(hero.level) * float(hero.star)),
+    ('level', lambda hero: float(hero.level)),
+    ('skin', lambda hero: float(hero.skin_level)),
+    ('star', lambda hero: float(hero.star)),
+    ('titan_gift_level', lambda hero: float(hero.titan_gift_level or 0.0)),
+)
+
+# The features in the order of the compiled columns.
+HERO_FUNCTIONS = tuple(function for _, function in (*TOTAL_FEATURES, *HERO_FEATURES))
+
+# Features of the hero items. The name is followed by the hero ID and the item key.
+ITEM_PREFIXES = ('artifact_level', 'artifact_star', 'rune', 'skill', 'slot')
+
+
+class FeatureVectorizer:
+    """
+    Maps heroes to sparse feature rows without building the feature names.
+
+    Feature names are parsed once, and the column indexes get compiled per hero ID.
+    If `is_fitting` is set, unknown features are appended to `feature_names`.
+    Otherwise, they're ignored.
+    """
+
+    def __init__(self, feature_names: Iterable[str] = (), is_fitting: bool = False):
+        self.feature_names: List[str] = []
+        self.is_fitting = is_fitting
+        self.columns: Dict[str, int] = {}
+
+        # Item feature columns: prefix → hero ID → item key → column.
+        self.item_columns: Dict[str, Dict[str, Dict[Any, int]]] = {prefix: {} for prefix in ITEM_PREFIXES}
+
+        # Compiled columns of the hero features, `-1` for the unknown ones.
+        self.hero_columns: Dict[str, numpy.ndarray] = {}
+
+        for name in feature_names:
+            self.add_feature(name)
+
+    @property
+    def n_features(self) -> int:
+        return len(self.feature_names)
+
+    def add_feature(self, name: str) -> int:
+        column = self.columns[name] = len(self.feature_names)
+        self.feature_names.append(name)
+        for prefix in ITEM_PREFIXES:
+            if name.startswith(f'{prefix}_'):
+                hero_id, _, key = name[len(prefix) + 1:].partition('_')
+                self.item_columns[prefix].setdefault(hero_id, {})[self.parse_item_key(prefix, key)] = column
+                break
+        return column
+
+    @staticmethod
+    def parse_item_key(prefix: str, key: str) -> Any:
+        # Artifacts and runes are enumerated, skills and slots are identified by strings.
+        return int(key) if prefix in ('artifact_level', 'artifact_star', 'rune') and key.isdigit() else key
+
+    def get_column(self, name: str) -> int:
+        column = self.columns.get(name)
+        if column is not None:
+            return column
+        return self.add_feature(name) if self.is_fitting else -1
+
+    def get_item_column(self, prefix: str, hero_id: str, key: Any) -> int:
+        column = self.item_columns[prefix].get(hero_id, {}).get(key)
+        if column is not None:
+            return column
+        return self.add_feature(f'{prefix}_{hero_id}_{key}') if self.is_fitting else -1
+
+    def compile_hero(self, hero_id: str) -> numpy.ndarray:
+        """
+        Gets the columns of the shared and the hero features.
+        """
+        columns = self.hero_columns.get(hero_id)
+        if columns is None:
+            columns = self.hero_columns[hero_id] = numpy.array([
+                *(self.get_column(name) for name, _ in TOTAL_FEATURES),
+                *(self.get_column(f'{prefix}_{hero_id}') for prefix, _ in HERO_FEATURES),
+            ])
+        return columns
+
+    def transform_hero(self, hero: Hero) -> Tuple[List[int], List[float]]:
+        """
+        Gets the hero feature columns and values.
+        """
+        values = [function(hero) for function in HERO_FUNCTIONS]
+        columns: List[int] = self.compile_hero(hero.id).tolist()
+
+        # Items.
+        for i, artifact in enumerate(hero.artifacts):
+            columns.append(self.get_item_column('artifact_level', hero.id, i))
+            values.append(artifact['level'])
+            columns.append(self.get_item_column('artifact_star', hero.id, i))
+            values.append(artifact['star'])
+        for i, level in enumerate(hero.runes):
+            columns.append(self.get_item_column('rune', hero.id, i))
+            values.append(float(level))
+        for skill_id, level in hero.skills.items():
+            columns.append(self.get_item_column('skill', hero.id, skill_id))
+            values.append(float(level))
+        for n_slot in dict.fromkeys(hero.slots):  # a slot is a flag, even if it's listed twice
+            columns.append(self.get_item_column('slot', hero.id, n_slot))
+            values.append(1.0)
+
+        return columns, values
+
+    def transform(self, heroes: Iterable[Hero]) -> csr_matrix:
+        """
+        Makes the sparse matrix of the hero features. Shape is number of heroes × number of features.
+        """
+        rows: List[int] = []
+        columns: List[int] = []
+        values: List[float] = []
+        n_heroes = 0
+        for row, hero in enumerate(heroes):
+            hero_columns, hero_values = self.transform_hero(hero)
+            rows.extend([row] * len(hero_columns))
+            columns.extend(hero_columns)
+            values.extend(hero_values)
+            n_heroes = row + 1
+        return self.make_matrix(rows, columns, values, (n_heroes, self.n_features))
+
+    @staticmethod
+    def make_matrix(rows: List[int], columns: List[int], values: List[float], shape: Tuple[int, int]) -> csr_matrix:
+        """
+        Makes the sparse matrix skipping the unknown features. Values of the same cell are summed up.
+        """
+        rows_array = numpy.array(rows, dtype=int)
+        columns_array = numpy.array(columns, dtype=int)
+        is_known = columns_array != -1
+        matrix = csr_matrix(
+            (numpy.array(values, dtype=float)[is_known], (rows_array[is_known], columns_array[is_known])),
+            shape=shape,
+        )
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        return matrix
+
+
+def get_hero_features(hero: Hero) -> Dict[str, float]:
+    """
+    Gets the hero features by name. Slow, it's meant for debugging and tests.
+    """
+    vectorizer = FeatureVectorizer(is_fitting=True)
+    features: Dict[str, float] = {}
+    for column, value in zip(*vectorizer.transform_hero(hero)):
+        name = vectorizer.feature_names[column]
+        features[name] = features.get(name, 0.0) + value
+    return features
+
+
+class HeroTable:
+    """
+    Hero roster in the struct-of-arrays layout. Hero attributes are read once, so that the roster algorithms
+    run on the NumPy columns. If the vectorizer is given, the hero feature matrix is computed as well.
+    Indexing and iteration give the heroes themselves, thus the table may be used in place of the hero list.
+    """
+
+    def __init__(self, heroes: Iterable[Hero], vectorizer: Optional[FeatureVectorizer] = None):
+        self.heroes: List[Hero] = list(heroes)
+        self.ids = numpy.array([hero.id for hero in self.heroes], dtype=str)
+        self.power = numpy.array([hero.power or 0 for hero in self.heroes], dtype=int)
+        self.level = numpy.array([hero.level for hero in self.heroes], dtype=int)
+        self.star = numpy.array([hero.star for hero in self.heroes], dtype=int)
+        self.color = numpy.array([hero.color for hero in self.heroes], dtype=int)
+        self.features: Optional[csr_matrix] = vectorizer.transform(self.heroes) if vectorizer is not None else None
+
+    def __len__(self) -> int:
+        return len(self.heroes)
+
+    def __getitem__(self, index: int) -> Hero:
+        return self.heroes[index]
+
+    def __iter__(self) -> Iterator[Hero]:
+        return iter(self.heroes)
+
+    def take(self, indexes: Iterable[int]) -> List[Hero]:
+        return [self.heroes[index] for index in indexes]
@@ -1,11 +1,13 @@
 from __future__ import annotations
 
-from itertools import combinations
-from operator import attrgetter
-from typing import Iterable, List, Optional, Sequence, TypeVar
+from itertools import chain, combinations, islice
+from typing import Iterable, List, Optional, TypeVar
+
+import numpy
 
 from bestmobabot import constants
 from bestmobabot.dataclasses_ import Hero, Unit
+from bestmobabot.features import HeroTable
 
 TUnit = TypeVar('TUnit', bound=Unit)
 
@@ -22,23 +24,36 @@ def get_team_power(team: Iterable[TUnit]) -> int:
     return sum(hero.power for hero in team)
 
 
-def naive_select_attackers(units: Iterable[TUnit], count: int = constants.TEAM_SIZE) -> List[TUnit]:
+def naive_select_attackers(heroes: HeroTable, count: int = constants.TEAM_SIZE) -> List[Hero]:
     """
-    Selects the most powerful units.
+    Selects the most powerful heroes.
     """
-    return sorted(units, key=attrgetter('power'), reverse=True)[:count]
+    return heroes.take(numpy.argsort(-heroes.power, kind='stable')[:count])
 
 
-def find_expedition_team(heroes: Iterable[Hero], min_power: int) -> Optional[Sequence[Hero]]:
+def find_expedition_team(heroes: HeroTable, min_power: int) -> Optional[List[Hero]]:
+    """
+    Finds the least powerful team which is still powerful enough.
+    Team powers are summed up in chunks of the hero index combinations.
+    """
     best_power: Optional[int] = None
     best_team = None
 
-    for team in combinations(heroes, constants.TEAM_SIZE):
-        power = get_team_power(team)
-        if power < min_power:
+    teams = combinations(range(len(heroes)), constants.TEAM_SIZE)
+    while True:
+        chunk = numpy.fromiter(
+            chain.from_iterable(islice(teams, constants.EXPEDITION_TEAMS_CHUNK_SIZE)),
+            dtype=int,
+        ).reshape(-1, constants.TEAM_SIZE)
+        if not chunk.size:
+            break
+        powers = heroes.power[chunk].sum(axis=1)
+        candidates = numpy.flatnonzero(powers >= min_power)
+        if not candidates.size:
             continue
-        if best_power is None or best_power > power:
-            best_power = power
-            best_team = team
+        index = candidates[numpy.argmin(powers[candidates])]
+        if best_power is None or best_power > powers[index]:
+            best_power = powers[index]
+            best_team = chunk[index]
 
-    return best_team
+    return heroes.take(best_team) if best_team is not None else None
@@ -5,7 +5,8 @@ More `itertools`.
 from __future__ import annotations
 
 import math
-from typing import Any, Iterable, Iterator, List, Optional, TypeVar
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Optional, TypeVar
 
 from loguru import logger
 
@@ -41,9 +42,10 @@ class CountDown(Iterator[T]):
         self.is_fresh = True
 
 
-def secretary_max(items: Iterable[T], n: int, early_stop: Any = None) -> T:
+def secretary_max(items: Iterable[T], n: int, early_stop: Any = None) -> Optional[T]:
     """
     Select best item while lazily iterating over the items.
+    If the items run out earlier than expected, the best seen item is returned.
     https://en.wikipedia.org/wiki/Secretary_problem#Deriving_the_optimal_policy
     """
     r = int(n / math.e) + 1
@@ -68,7 +70,24 @@ def secretary_max(items: Iterable[T], n: int, early_stop: Any = None) -> T:
             # Otherwise, update the best key.
             max_item = item
 
-    raise RuntimeError('unreachable code')
+    logger.trace('Items are exhausted.')
+    return max_item
+
+
+def prefetch(get: Callable[[], T], n: int, is_stopped: Callable[[], bool] = lambda: False) -> Iterator[T]:
+    """
+    Calls `get` up to `n` times. The next item is requested in background while the current one is being processed.
+    Once `is_stopped` returns true, the next item is not requested anymore, and the current one is the last.
+    When closed early, waits for the pending call to finish and discards its result. Thus, an early stop still costs
+    one more `get` call, e.g. one more arena page request with its random sleep.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future: Optional[Future] = executor.submit(get) if n else None
+        while future is not None:
+            item = future.result()
+            n -= 1
+            future = executor.submit(get) if n and not is_stopped() else None
+            yield item
 
 
 def slices(n: int, length: int) -> List[slice]:
@@ -1,31 +1,344 @@
+from __future__ import annotations
+
 import pickle
-from base64 import b85encode
-from collections import defaultdict
+from base64 import b64decode, b64encode, b85decode, b85encode
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from copy import copy
 from itertools import product
 from operator import itemgetter
-from typing import Any, DefaultDict, Dict, Iterable, List, NamedTuple, Optional
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from uuid import uuid4
 
+import joblib
 import numpy
 from loguru import logger
-from pandas import DataFrame, Series
 from scipy import stats
+from scipy.sparse import csr_matrix
+from scipy.special import expit
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import StratifiedKFold, cross_val_score
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import StratifiedKFold, train_test_split
+from sklearn.preprocessing import MaxAbsScaler
+from sklearn.tree._tree import TREE_LEAF
 
 from bestmobabot import constants, dataclasses_
 from bestmobabot.database import Database
+from bestmobabot.features import FEATURES_VERSION, FeatureVectorizer
 
 
 class Model(NamedTuple):
     estimator: RandomForestClassifier
     feature_names: List[str]
+    forest: Optional[CompiledForest] = None  # built on loading, never stored
+    surrogate: Optional[LinearSurrogate] = None  # cheap linear model to pre-select the candidates for the forest
+
+    @staticmethod
+    def loads(value: str) -> Model:
+        model: Model = pickle.loads(b85decode(value))
+        return model.compile()
+
+    def dumps(self) -> str:
+        return b85encode(pickle.dumps(self._replace(forest=None), protocol=pickle.HIGHEST_PROTOCOL)).decode()
+
+    def compile(self) -> Model:
+        return self._replace(forest=CompiledForest(self.estimator))
+
+
+class LinearSurrogate(NamedTuple):
+    """
+    Logistic regression on the raw features. It's just a dot product, thus much cheaper than the forest.
+    """
+
+    coef: numpy.ndarray
+    intercept: float
+
+    @staticmethod
+    def fit(x, y) -> LinearSurrogate:
+        scaler = MaxAbsScaler()
+        estimator = LogisticRegression(class_weight='balanced', max_iter=1000).fit(scaler.fit_transform(x), y)
+        # Fold the scaling into the coefficients, so that the raw features can be used.
+        return LinearSurrogate(estimator.coef_[0] / scaler.scale_, float(estimator.intercept_[0]))
+
+    def predict_proba(self, x: numpy.ndarray) -> numpy.ndarray:
+        """
+        Predicts the positive class probabilities.
+        """
+        return expit(x @ self.coef + self.intercept)
+
+
+class CompiledForest:
+    """
+    Random forest packed into flat NumPy arrays.
+
+    `predict_proba` has significant per-call overhead (input validation, joblib dispatch, per-tree calls),
+    which dominates on a few hundred rows. Here all the trees are walked at once, level by level.
+    """
+
+    def __init__(self, estimator: RandomForestClassifier):
+        trees = [tree.tree_ for tree in estimator.estimators_]
+        offsets = numpy.cumsum([0, *(tree.node_count for tree in trees)])
+        is_leaf = numpy.concatenate([tree.children_left == TREE_LEAF for tree in trees])
+
+        self.n_trees = len(trees)
+        self.roots = offsets[:-1]
+        self.is_leaf = is_leaf
+
+        # Only a small part of the features is actually used in the splits. Keep just those.
+        features = numpy.concatenate([tree.feature for tree in trees])
+        self.used_features, features[~is_leaf] = numpy.unique(features[~is_leaf], return_inverse=True)
+        self.features = features
+        self.thresholds = numpy.concatenate([tree.threshold for tree in trees])
+        self.children_left = numpy.concatenate([tree.children_left + offset for tree, offset in zip(trees, offsets)])
+        self.children_right = numpy.concatenate([tree.children_right + offset for tree, offset in zip(trees, offsets)])
+
+        # Normalize the same way as `DecisionTreeClassifier.predict_proba` does.
+        values = numpy.concatenate([tree.value[:, 0, :] for tree in trees])
+        normalizer = values.sum(axis=1)
+        normalizer[normalizer == 0.0] = 1.0
+        self.values = values[:, 1] / normalizer
+
+    # Rows are walked in chunks to keep the working set in the CPU cache.
+    chunk_size = 512
+
+    def predict_proba(self, x: numpy.ndarray) -> numpy.ndarray:
+        """
+        Predicts the positive class probabilities. The same as `estimator.predict_proba(x)[:, 1]`.
+        """
+        return self.predict_used_proba(numpy.asarray(x)[:, self.used_features])
+
+    def predict_used_proba(self, x: numpy.ndarray) -> numpy.ndarray:
+        """
+        Predicts the positive class probabilities given only the used features, in the `used_features` order.
+        """
+        x = numpy.asarray(x, dtype=numpy.float32)  # the trees are fitted on `float32`
+        if x.shape[0] <= self.chunk_size:
+            return self.predict_chunk(x)
+        return numpy.concatenate([
+            self.predict_chunk(x[start:start + self.chunk_size])
+            for start in range(0, x.shape[0], self.chunk_size)
+        ])
+
+    def predict_chunk(self, x: numpy.ndarray) -> numpy.ndarray:
+        n_rows, n_features = x.shape
+        x = x.ravel()
+        row_offsets = numpy.arange(n_rows) * n_features
+
+        # Walk all the trees for all the rows at once. Only the walks which haven't reached a leaf yet are advanced.
+        nodes = numpy.repeat(self.roots, n_rows)
+        row_offsets = numpy.tile(row_offsets, self.n_trees)
+        active = numpy.flatnonzero(~self.is_leaf[nodes])
+        while active.size:
+            active_nodes = nodes[active]
+            go_left = x[row_offsets[active] + self.features[active_nodes]] <= self.thresholds[active_nodes]
+            active_nodes = numpy.where(go_left, self.children_left[active_nodes], self.children_right[active_nodes])
+            nodes[active] = active_nodes
+            active = active[~self.is_leaf[active_nodes]]
+        nodes = nodes.reshape(self.n_trees, n_rows)
+
+        # Accumulate in the same order as the forest does to get exactly the same result.
+        proba = numpy.zeros(n_rows)
+        for values in self.values[nodes]:
+            proba += values
+        proba /= self.n_trees
+        return proba
+
+
+class BattleChunk(NamedTuple):
+    """
+    Parsed battles. Battle features are the attackers features minus the defenders ones.
+    Only the features which are present in the battles are kept.
+    """
+
+    ids: List[str]  # replay IDs
+    start_times: numpy.ndarray  # battle timestamps
+    x: csr_matrix  # battle features
+    y: numpy.ndarray  # whether the attackers have won
+    feature_names: List[str]
+
+    @staticmethod
+    def parse(replays: List[Tuple[str, Dict[str, Any]]]) -> BattleChunk:
+        """
+        Parses the replays given as the replay IDs and the stored replay values.
+        """
+        vectorizer = FeatureVectorizer(is_fitting=True)
+        rows: List[int] = []
+        columns: List[int] = []
+        values: List[float] = []
+        for row, (_, battle) in enumerate(replays):
+            for heroes, multiplier in (
+                (battle.get('attackers') or battle['player'], +1.0),
+                (battle.get('defenders') or battle['enemies'], -1.0),
+            ):
+                for hero in heroes:
+                    hero_columns, hero_values = vectorizer.transform_hero(dataclasses_.Hero.parse_obj(hero))
+                    rows.extend([row] * len(hero_columns))
+                    columns.extend(hero_columns)
+                    values.extend(multiplier * value for value in hero_values)
+        return BattleChunk(
+            ids=[replay_id for replay_id, _ in replays],
+            start_times=numpy.array([battle.get('start_time', 0.0) for _, battle in replays], dtype=float),
+            x=vectorizer.make_matrix(rows, columns, values, (len(replays), vectorizer.n_features)),
+            y=numpy.array([battle['win'] for _, battle in replays], dtype=bool),
+            feature_names=vectorizer.feature_names,
+        ).take(numpy.arange(len(replays)))
+
+    @staticmethod
+    def concatenate(chunks: Iterable[BattleChunk]) -> BattleChunk:
+        """
+        Joins the chunks together. The chunk columns are mapped onto the joined feature names.
+        """
+        columns: Dict[str, int] = {}
+        ids: List[str] = []
+        start_times: List[numpy.ndarray] = [numpy.zeros(0)]
+        ys: List[numpy.ndarray] = [numpy.zeros(0, dtype=bool)]
+        rows: List[numpy.ndarray] = [numpy.zeros(0, dtype=int)]
+        chunk_columns: List[numpy.ndarray] = [numpy.zeros(0, dtype=int)]
+        values: List[numpy.ndarray] = [numpy.zeros(0)]
+        for chunk in chunks:
+            mapping = numpy.array([columns.setdefault(name, len(columns)) for name in chunk.feature_names], dtype=int)
+            x = chunk.x.tocoo()
+            rows.append(x.row + len(ids))
+            chunk_columns.append(mapping[x.col])
+            values.append(x.data)
+            ids.extend(chunk.ids)
+            start_times.append(chunk.start_times)
+            ys.append(chunk.y)
+        x = csr_matrix(
+            (numpy.concatenate(values), (numpy.concatenate(rows), numpy.concatenate(chunk_columns))),
+            shape=(len(ids), len(columns)),
+        )
+        x.sum_duplicates()
+        return BattleChunk(
+            ids=ids,
+            start_times=numpy.concatenate(start_times),
+            x=x,
+            y=numpy.concatenate(ys),
+            feature_names=list(columns),
+        )
+
+    def take(self, indexes: numpy.ndarray) -> BattleChunk:
+        """
+        Takes the battles by their indexes. The features which are not present in the battles are dropped.
+        """
+        x: csr_matrix = self.x[indexes]
+        used_features = numpy.unique(x.indices)
+        return BattleChunk(
+            ids=[self.ids[index] for index in indexes],
+            start_times=self.start_times[indexes],
+            x=x[:, used_features],
+            y=self.y[indexes],
+            feature_names=[self.feature_names[index] for index in used_features],
+        )
+
+    def take_last(self, n_battles: int) -> BattleChunk:
+        """
+        Takes the latest unique battles.
+        """
+        _, indexes = numpy.unique(self.ids, return_index=True)
+        indexes = indexes[numpy.argsort(self.start_times[indexes], kind='stable')]
+        return self.take(indexes[-n_battles:])
+
+    @staticmethod
+    def loads(value: Dict[str, Any]) -> BattleChunk:
+        return BattleChunk(
+            ids=value['ids'],
+            start_times=numpy.array(value['start_times'], dtype=float),
+            x=csr_matrix(
+                (
+                    numpy.frombuffer(b64decode(value['data']), dtype=numpy.float64),
+                    numpy.frombuffer(b64decode(value['indices']), dtype=numpy.int32),
+                    numpy.frombuffer(b64decode(value['indptr']), dtype=numpy.int32),
+                ),
+                shape=(len(value['ids']), len(value['feature_names'])),
+            ),
+            y=numpy.array(value['wins'], dtype=bool),
+            feature_names=value['feature_names'],
+        )
+
+    def dumps(self) -> Dict[str, Any]:
+        return {
+            'ids': self.ids,
+            'start_times': self.start_times.tolist(),
+            'wins': self.y.tolist(),
+            'feature_names': self.feature_names,
+            'data': b64encode(self.x.data.astype(numpy.float64).tobytes()).decode(),
+            'indices': b64encode(self.x.indices.astype(numpy.int32).tobytes()).decode(),
+            'indptr': b64encode(self.x.indptr.astype(numpy.int32).tobytes()).decode(),
+        }
+
+
+class BattleStore:
+    """
+    Parsed battles stored in the database, so that each replay gets parsed only once.
+
+    Chunks are written once, and each one has its own feature names. Thus, concurrent writers don't interfere.
+    Small chunks, which are written on each replay fetch, are merged while loading.
+    The key prefix includes the features version. Chunks of the other versions are discarded while loading.
+    """
+
+    prefix = f'battles:v{FEATURES_VERSION}:'
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    def add(self, replays: List[Tuple[str, Dict[str, Any]]]) -> BattleChunk:
+        """
+        Parses and stores the replays given as the replay IDs and the stored replay values.
+        """
+        chunk = BattleChunk.parse(replays)
+        self.store(chunk)
+        return chunk
+
+    def store(self, chunk: BattleChunk):
+        for start in range(0, len(chunk.ids), constants.MODEL_BATTLES_CHUNK_SIZE):
+            indexes = numpy.arange(start, min(start + constants.MODEL_BATTLES_CHUNK_SIZE, len(chunk.ids)))
+            self.db[f'{self.prefix}{uuid4().hex}'] = chunk.take(indexes).dumps()
+
+    def load(self) -> BattleChunk:
+        """
+        Loads all the stored battles. Small chunks are merged, so that their number doesn't grow indefinitely.
+        """
+        stale_keys = [key for key in self.db.get_keys_by_prefix('battles:') if not key.startswith(self.prefix)]
+        if stale_keys:
+            logger.info(f'Discarding {len(stale_keys)} battle chunks of the other features version…')
+            for key in stale_keys:
+                del self.db[key]
+
+        chunks = {key: BattleChunk.loads(value) for key, value in self.db.get_by_prefix(self.prefix)}
+        small_keys = [key for key, chunk in chunks.items() if len(chunk.ids) < constants.MODEL_BATTLES_CHUNK_SIZE]
+        if len(small_keys) > 1:
+            logger.info(f'Merging {len(small_keys)} small battle chunks…')
+            # The merged chunks are written first, so that no battle gets lost.
+            self.store(BattleChunk.concatenate(chunks[key] for key in small_keys))
+            for key in small_keys:
+                del self.db[key]
+        return BattleChunk.concatenate(chunks.values())
 
 
 class Trainer:
-    def __init__(self, db: Database, *, n_splits: int, n_last_battles: int):
+    def __init__(
+        self,
+        db: Database,
+        *,
+        n_splits: int,
+        n_last_battles: int,
+        n_processes: int = 1,
+        search: str = 'halving',
+    ):
+        """
+        :param search: `halving` to screen the hyper-parameters on the subsamples before the cross-validation,
+            `cv` to cross-validate all of them, `oob` to use out-of-bag.
+        """
         self.db = db
         self.n_splits = n_splits
         self.n_last_battles = n_last_battles
+        self.n_processes = n_processes
+        self.search = search
 
     def train(self):
         """
@@ -33,54 +346,66 @@ class Trainer:
         """
         numpy.random.seed(42)
 
-        # Read battles.
-        battle_list = self.deduplicate_battles(self.read_battles())
-        if not battle_list:
+        # Read battles. Each battle has only a small part of all the features, thus X is sparse.
+        battles = self.read_battles()
+        if not battles.ids:
             logger.info('There are no battles. Wait until someone attacks you.')
             return
-        battles = DataFrame(battle_list).fillna(value=0.0)
-        logger.info(f'Battles shape: {battles.shape}.')
-
-        # Split into X and y.
-        x: DataFrame = battles.drop(['win'], axis=1)
-        y: Series = battles['win']
-        value_counts: DataFrame = y.value_counts()
-        logger.info(f'Wins: {value_counts[False]}. Losses: {value_counts[True]}.')
+        x, y = self.deduplicate_battles(battles.x, battles.y)
+        feature_names = battles.feature_names
+        logger.info(f'Battles shape: {x.shape}, {x.nnz} non-zeros.')
+        logger.info(f'Wins: {numpy.count_nonzero(~y)}. Losses: {numpy.count_nonzero(y)}.')
 
         # Here's our model.
         estimator = RandomForestClassifier(class_weight='balanced', n_jobs=-1)
 
         # Search for hyper-parameters if not explicitly set.
-        params = self.search_hyper_parameters(
-            x, y, estimator, constants.MODEL_PARAM_GRID, StratifiedKFold(n_splits=self.n_splits, shuffle=True))
+        search_cv = self.search_hyper_parameters(x, y, estimator, constants.MODEL_PARAM_GRID)
 
-        # Re-train the best model on the entire data.
-        logger.info(f'Refitting with params: {params}…')
-        estimator.set_params(**params).fit(x, y)
+        # Re-train the best model on the entire data, unless the search has already done that.
+        if search_cv.best_estimator_ is not None:
+            logger.info('Taking the best out-of-bag scored forest.')
+            estimator = search_cv.best_estimator_
+        else:
+            logger.info(f'Refitting with params: {search_cv.best_params_}…')
+            estimator.set_params(**search_cv.best_params_).fit(x, y)
         if not numpy.array_equal(estimator.classes_, numpy.array([False, True])):
             raise RuntimeError(f'unexpected classes: {estimator.classes_}')
 
         # Print debugging info.
-        for column, importance in sorted(zip(x.columns, estimator.feature_importances_), key=itemgetter(1), reverse=True):  # noqa
+        for column, importance in sorted(zip(feature_names, estimator.feature_importances_), key=itemgetter(1), reverse=True):  # noqa
             if importance > 0.0001:
                 logger.trace(f'Feature {column}: {importance:.4f}')
 
+        logger.info('Fitting surrogate…')
+        surrogate = LinearSurrogate.fit(x, y)
+
         logger.info('Saving model…')
-        self.db['bot:model'] = b85encode(pickle.dumps(
-            Model(estimator, list(x.columns)),
-            protocol=pickle.HIGHEST_PROTOCOL,
-        )).decode()
+        self.db['bot:model'] = Model(estimator, feature_names, surrogate=surrogate).dumps()
 
         logger.info('Optimizing database…')
         self.db.vacuum()
 
         logger.info('Finished.')
 
-    @staticmethod
-    def search_hyper_parameters(x, y, estimator, param_grid, cv) -> Dict:
+    def search_hyper_parameters(self, x, y, estimator, param_grid) -> TTestSearchCV:
         logger.info('Searching for the best hyper-parameters…')
-        search_cv = TTestSearchCV(
-            estimator, param_grid, cv=cv, scoring=constants.MODEL_SCORING, alpha=constants.MODEL_SCORING_ALPHA)
+        if self.search == 'oob':
+            search_cv = OOBSearchCV(
+                estimator,
+                param_grid,
+                scoring=constants.MODEL_SCORING,
+                alpha=constants.MODEL_SCORING_ALPHA,
+            )
+        else:
+            search_cv = (HalvingTTestSearchCV if self.search == 'halving' else TTestSearchCV)(
+                estimator,
+                param_grid,
+                cv=StratifiedKFold(n_splits=self.n_splits, shuffle=True),
+                scoring=constants.MODEL_SCORING,
+                alpha=constants.MODEL_SCORING_ALPHA,
+                n_processes=self.n_processes,
+            )
 
         try:
             search_cv.fit(x, y)
@@ -91,56 +416,56 @@ class Trainer:
         logger.info(f'Best score: {search_cv.best_score_:.4f} ({score_interval[0]:.4f} … {score_interval[1]:.4f})')
         logger.info(f'Best params: {search_cv.best_params_}')
 
-        return search_cv.best_params_
+        return search_cv
 
-    def read_battles(self) -> Iterable[Dict[str, Any]]:
-        logger.info('Selecting battles…')
-        values = [value for _, value in self.db.get_by_prefix('replays:')]
-        logger.info('Sorting battles…')
-        values.sort(key=lambda value: value.get('start_time', 0.0))
-        values = values[-self.n_last_battles:]
-        logger.info('Parsing battles…')
-        return [self.parse_battle(value) for value in values]
+    def read_battles(self) -> BattleChunk:
+        logger.info('Loading parsed battles…')
+        store = BattleStore(self.db)
+        battles = store.load()
 
-    @staticmethod
-    def deduplicate_battles(battles: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        return list(dict(items) for items in {tuple(sorted(battle.items())) for battle in battles})
+        # Parse the replays which haven't been stored yet, for example the ones fetched before the store existed.
+        stored_ids = set(battles.ids)
+        new_keys = [key for key in self.db.get_keys_by_prefix('replays:') if key[len('replays:'):] not in stored_ids]
+        if new_keys:
+            logger.info(f'Parsing {len(new_keys)} new battles…')
+            new_battles = store.add([(key[len('replays:'):], self.db[key]) for key in new_keys])
+            battles = BattleChunk.concatenate([battles, new_battles])
 
-    @classmethod
-    def parse_battle(cls, battle: Dict[str, Any]) -> Dict[str, Any]:
-        # Yield battle itself.
-        result = defaultdict(int)
-        cls.parse_heroes(battle.get('attackers') or battle['player'], +1, result)
-        cls.parse_heroes(battle.get('defenders') or battle['enemies'], -1, result)
-        return {'win': battle['win'], **result}
+        return battles.take_last(self.n_last_battles)
 
     @staticmethod
-    def parse_heroes(heroes: Iterable[Dict[str, int]], multiplier: int, result: DefaultDict[str, int]):
-        for hero in heroes:
-            for key, value in dataclasses_.Hero.parse_obj(hero).features.items():
-                result[key] += multiplier * value
+    def deduplicate_battles(x: csr_matrix, y: numpy.ndarray) -> Tuple[csr_matrix, numpy.ndarray]:
+        """
+        Drops the repeated battles, the first one of them is kept.
+        """
+        indexes: Dict[Tuple[bytes, bytes, bool], int] = {}
+        for i, (start, end) in enumerate(zip(x.indptr[:-1], x.indptr[1:])):
+            indexes.setdefault((x.indices[start:end].tobytes(), x.data[start:end].tobytes(), bool(y[i])), i)
+        unique_indexes = numpy.array(sorted(indexes.values()), dtype=int)
+        return x[unique_indexes], y[unique_indexes]
 
 
 class TTestSearchCV:
-    def __init__(self, estimator, param_grid, *, cv, scoring, alpha=0.95):
+    def __init__(self, estimator, param_grid, *, cv, scoring, alpha=0.95, n_processes: int = 1):
+        """
+        :param n_processes: number of worker processes to fit the folds in parallel, `1` to fit in-process.
+        """
         self.estimator = estimator
         self.param_grid: Dict[str, Any] = param_grid
         self.cv = cv
         self.scoring = scoring
         self.alpha = alpha
+        self.n_processes = n_processes
 
         self.p = 1.0 - alpha
         self.best_params_: Optional[Dict[str, Any]] = None
         self.best_score_: Optional[float] = None
         self.best_scores_: Optional[numpy.ndarray] = None
         self.best_confidence_interval_: Optional[numpy.ndarray] = None
+        self.best_estimator_: Optional[RandomForestClassifier] = None  # fitted on the entire data, if available
 
     def fit(self, x, y):
-        for values in product(*self.param_grid.values()):
-            params = dict(zip(self.param_grid.keys(), values))
-            self.estimator.set_params(**params)
-            logger.trace(f'CV started: {params}')
-            scores: numpy.ndarray = cross_val_score(self.estimator, x, y, scoring=self.scoring, cv=self.cv)
+        for params, scores in self.cross_validate(x, y):
             score: float = scores.mean()
             logger.debug(f'Score: {score:.4f} with {params}.')
             if not self.is_better_score(score, scores):
@@ -149,6 +474,7 @@ class TTestSearchCV:
             self.best_params_ = params
             self.best_score_ = score
             self.best_scores_ = scores
+            self.best_estimator_ = self.get_estimator(params)
             self.best_confidence_interval_ = stats.t.interval(
                 self.alpha,
                 len(scores) - 1,
@@ -156,6 +482,125 @@ class TTestSearchCV:
                 scale=stats.sem(scores),
             )
 
+    def cross_validate(self, x, y) -> Iterable[Tuple[Dict[str, Any], numpy.ndarray]]:
+        """
+        Yields the parameters and their cross-validation scores. The number of trees goes in the ascending order.
+
+        A forest is a prefix of a larger one given the same random state. Thus, only the largest forest
+        is fitted for each fold, and the smaller ones are scored by taking its first trees.
+        """
+        n_estimators_choices, other_params = self.split_grid()
+        with self.open_executor(x, y) as executor:
+            yield from self.cross_validate_params(executor, x, y, n_estimators_choices, other_params)
+
+    def cross_validate_params(
+        self,
+        executor: Optional[ProcessPoolExecutor],
+        x,
+        y,
+        n_estimators_choices: List[int],
+        other_params: List[Dict[str, Any]],
+    ) -> Iterable[Tuple[Dict[str, Any], numpy.ndarray]]:
+        """
+        Cross-validates the combinations of the other parameters with each number of trees.
+        """
+        splits = list(self.cv.split(x, y))
+        jobs = [
+            (params, n_estimators_choices, self.scoring, train_indexes, test_indexes)
+            for params in other_params
+            for train_indexes, test_indexes in splits
+        ]
+        with closing(self.run_jobs(executor, score_fold, x, y, jobs)) as fold_scores:
+            # The scores come in the grid order, so that the t-test proceeds as soon as a grid point is ready.
+            yield from self.collect_scores(other_params, n_estimators_choices, len(splits), fold_scores)
+
+    def split_grid(self) -> Tuple[List[int], List[Dict[str, Any]]]:
+        """
+        Splits the grid into the numbers of trees and the combinations of the other parameters.
+        """
+        n_estimators_choices = sorted(self.param_grid.get('n_estimators', [self.estimator.n_estimators]))
+        other_grid = {key: values for key, values in self.param_grid.items() if key != 'n_estimators'}
+        return n_estimators_choices, [dict(zip(other_grid.keys(), values)) for values in product(*other_grid.values())]
+
+    def make_params(self, other_params: Dict[str, Any], n_estimators: int) -> Dict[str, Any]:
+        params = {**other_params, 'n_estimators': n_estimators}
+        return {key: params[key] for key in self.param_grid}
+
+    @contextmanager
+    def open_executor(self, x, y) -> Iterator[Optional[ProcessPoolExecutor]]:
+        """
+        Starts the worker processes, if needed. The data is shared with the workers via a memory-mapped file.
+        """
+        if self.n_processes == 1:
+            yield None
+            return
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / 'battles.joblib'
+            joblib.dump((x, y), path)
+            executor = ProcessPoolExecutor(self.n_processes, initializer=initialize_worker, initargs=(path,))
+            try:
+                yield executor
+            finally:
+                executor.shutdown()
+
+    def run_jobs(
+        self,
+        executor: Optional[ProcessPoolExecutor],
+        function: Callable[..., numpy.ndarray],
+        x,
+        y,
+        jobs: List[Tuple],
+    ) -> Iterator[numpy.ndarray]:
+        """
+        Calls the scoring function for each job and yields the results in the job order.
+        Pending jobs are cancelled when the iterator gets closed.
+        """
+        if executor is None:
+            for job in jobs:
+                yield function(self.estimator, x, y, *job)
+            return
+        # The forests get fitted in single threads, since the processes already run in parallel.
+        estimator = clone(self.estimator).set_params(n_jobs=1)
+        futures = [executor.submit(run_in_worker, function, estimator, *job) for job in jobs]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def collect_scores(
+        self,
+        other_params: List[Dict[str, Any]],
+        n_estimators_choices: List[int],
+        n_splits: int,
+        fold_scores: Iterator[numpy.ndarray],
+    ) -> Iterable[Tuple[Dict[str, Any], numpy.ndarray]]:
+        """
+        Groups the fold scores by the parameters.
+        """
+        for params in other_params:
+            logger.trace(f'CV started: {params}')
+            scores = numpy.column_stack([next(fold_scores) for _ in range(n_splits)])
+            for n_estimators, n_estimators_scores in zip(n_estimators_choices, scores):
+                yield self.make_params(params, n_estimators), n_estimators_scores
+
+    def get_estimator(self, params: Dict[str, Any]) -> Optional[RandomForestClassifier]:
+        """
+        Gets the estimator with the parameters fitted on the entire data. Cross-validation doesn't have one.
+        """
+        return None
+
+    @staticmethod
+    def truncate_forest(estimator: RandomForestClassifier, n_estimators: int) -> RandomForestClassifier:
+        """
+        Makes the forest of the first trees.
+        """
+        forest = copy(estimator)
+        forest.estimators_ = estimator.estimators_[:n_estimators]
+        forest.n_estimators = n_estimators
+        return forest
+
     def is_better_score(self, score: float, scores: numpy.ndarray) -> bool:
         if self.best_params_ is None:
             return True
@@ -164,3 +609,181 @@ class TTestSearchCV:
         _, p_value = stats.ttest_ind(self.best_scores_, scores)
         logger.trace(f'P-value: {p_value:.4f}.')
         return p_value < self.p
+
+
+class HalvingTTestSearchCV(TTestSearchCV):
+    """
+    Screens the combinations of the other parameters on the growing stratified subsamples before the cross-validation.
+    At each step, the largest forest of each combination is scored out-of-bag on the subsample, and the combinations
+    which are significantly worse than the best one are dropped. Each sample is a pair of the correctness values,
+    thus the paired t-test has much more power than on a handful of the fold scores.
+    The survivors are then cross-validated on the entire data and compared in the grid order as usual.
+    """
+
+    # Subsample sizes relative to the entire data. They take `7 / 8` of a single fit in total.
+    fractions = (1 / 8, 1 / 4, 1 / 2)
+
+    def cross_validate(self, x, y) -> Iterable[Tuple[Dict[str, Any], numpy.ndarray]]:
+        n_estimators_choices, other_params = self.split_grid()
+        with self.open_executor(x, y) as executor:
+            for fraction in self.fractions:
+                if len(other_params) == 1:
+                    break
+                indexes, _ = train_test_split(numpy.arange(x.shape[0]), train_size=fraction, stratify=y)
+                jobs = [(params, n_estimators_choices[-1], indexes) for params in other_params]
+                with closing(self.run_jobs(executor, score_out_of_bag, x, y, jobs)) as results:
+                    other_params = self.eliminate(other_params, list(results))
+                logger.debug(f'{len(other_params)} combinations are left after {len(indexes)} samples.')
+            yield from self.cross_validate_params(executor, x, y, n_estimators_choices, other_params)
+
+    def eliminate(self, other_params: List[Dict[str, Any]], scores: List[numpy.ndarray]) -> List[Dict[str, Any]]:
+        """
+        Drops the combinations which are significantly worse than the best one. The grid order is kept.
+        """
+        means = [numpy.nanmean(sample_scores) for sample_scores in scores]
+        best_scores = scores[int(numpy.argmax(means))]
+        survivors = []
+        for params, sample_scores, mean in zip(other_params, scores, means):
+            # All the combinations are scored on the same samples, thus the scores are paired.
+            is_paired = ~numpy.isnan(best_scores) & ~numpy.isnan(sample_scores)
+            if mean < max(means):
+                _, p_value = stats.ttest_rel(best_scores[is_paired], sample_scores[is_paired])
+                if p_value < self.p:
+                    logger.trace(f'Dropped {params}: {mean:.4f}, p-value {p_value:.4f}.')
+                    continue
+            survivors.append(params)
+        return survivors
+
+
+class OOBSearchCV(TTestSearchCV):
+    """
+    Scores the forests out-of-bag, that is each training sample by the trees which haven't seen it.
+    It takes a single fit on the entire data instead of `n_splits` fits and the refit.
+
+    The scores are the per-sample correctness, thus the score is the accuracy, and the t-test compares the samples.
+    """
+
+    def __init__(self, estimator, param_grid, *, scoring='accuracy', alpha=0.95):
+        if scoring != 'accuracy':
+            raise ValueError(f'only accuracy is supported out-of-bag, got: {scoring}')
+        super().__init__(estimator, param_grid, cv=None, scoring=scoring, alpha=alpha)
+        self.forest: Optional[RandomForestClassifier] = None  # the largest forest of the current parameters
+
+    def cross_validate(self, x, y) -> Iterable[Tuple[Dict[str, Any], numpy.ndarray]]:
+        n_estimators_choices, other_params_list = self.split_grid()
+
+        for other_params in other_params_list:
+            logger.trace(f'OOB started: {other_params}')
+            self.forest = clone(self.estimator).set_params(
+                **other_params,
+                n_estimators=n_estimators_choices[-1],
+                bootstrap=True,
+            ).fit(x, y)
+            for n_estimators, scores in self.iterate_scores(self.forest, x, y, n_estimators_choices):
+                yield self.make_params(other_params, n_estimators), scores[~numpy.isnan(scores)]
+
+    @classmethod
+    def iterate_scores(
+        cls,
+        forest: RandomForestClassifier,
+        x,
+        y,
+        n_estimators_choices: List[int],
+    ) -> Iterator[Tuple[int, numpy.ndarray]]:
+        """
+        Yields the out-of-bag correctness of each sample for each number of trees, `nan` for the samples not scored.
+        The predictions are accumulated tree by tree, so that each number of trees is scored on the way.
+        """
+        n_samples = x.shape[0]
+        proba = numpy.zeros((n_samples, len(forest.classes_)))
+        is_scored = numpy.zeros(n_samples, dtype=bool)
+        trees = zip(forest.estimators_, cls.get_unsampled_indexes(forest, n_samples))
+        for n_estimators, (tree, unsampled_indexes) in enumerate(trees, start=1):
+            proba[unsampled_indexes] += tree.predict_proba(x[unsampled_indexes])
+            is_scored[unsampled_indexes] = True
+            if n_estimators in n_estimators_choices:
+                scores = (forest.classes_[proba.argmax(axis=1)] == y).astype(float)
+                scores[~is_scored] = numpy.nan
+                yield n_estimators, scores
+
+    def get_estimator(self, params: Dict[str, Any]) -> Optional[RandomForestClassifier]:
+        return self.truncate_forest(self.forest, params['n_estimators'])
+
+    @staticmethod
+    def get_unsampled_indexes(forest: RandomForestClassifier, n_samples: int) -> Iterable[numpy.ndarray]:
+        """
+        Gets the out-of-bag sample indexes of each tree.
+        Newer scikit-learn exposes the bootstraps, since they may be drawn with the class weights.
+        Older one draws them uniformly with the tree random state, thus they're drawn again in the same way.
+        The private helpers are imported only here, so that their removal breaks only this search and not the bot.
+        """
+        if hasattr(forest, 'estimators_samples_'):
+            return (
+                numpy.flatnonzero(numpy.bincount(sample_indexes, minlength=n_samples) == 0)
+                for sample_indexes in forest.estimators_samples_
+            )
+        from sklearn.ensemble._forest import _generate_unsampled_indices, _get_n_samples_bootstrap
+        n_samples_bootstrap = _get_n_samples_bootstrap(n_samples, forest.max_samples)
+        return (
+            _generate_unsampled_indices(tree.random_state, n_samples, n_samples_bootstrap)
+            for tree in forest.estimators_
+        )
+
+
+# Parallel hyper-parameter search.
+# ----------------------------------------------------------------------------------------------------------------------
+
+worker_data: Optional[Tuple[Any, numpy.ndarray]] = None
+
+
+def initialize_worker(path: Path):
+    global worker_data
+    worker_data = joblib.load(path, mmap_mode='r')
+
+
+def score_fold(
+    estimator: RandomForestClassifier,
+    x: Any,
+    y: numpy.ndarray,
+    params: Dict[str, Any],
+    n_estimators_choices: List[int],
+    scoring: str,
+    train_indexes: numpy.ndarray,
+    test_indexes: numpy.ndarray,
+) -> numpy.ndarray:
+    """
+    Fits the largest forest on the fold and scores each number of trees.
+    """
+    estimator = clone(estimator).set_params(**params, n_estimators=n_estimators_choices[-1])
+    estimator.fit(x[train_indexes], y[train_indexes])
+    scorer = get_scorer(scoring)
+    x_test, y_test = x[test_indexes], y[test_indexes]
+    return numpy.array([
+        scorer(TTestSearchCV.truncate_forest(estimator, n_estimators), x_test, y_test)
+        for n_estimators in n_estimators_choices
+    ])
+
+
+def score_out_of_bag(
+    estimator: RandomForestClassifier,
+    x: Any,
+    y: numpy.ndarray,
+    params: Dict[str, Any],
+    n_estimators: int,
+    indexes: numpy.ndarray,
+) -> numpy.ndarray:
+    """
+    Fits the forest on the samples and gets the out-of-bag correctness of each of them.
+    """
+    x, y = x[indexes], y[indexes]
+    forest = clone(estimator).set_params(**params, n_estimators=n_estimators, bootstrap=True).fit(x, y)
+    *_, (_, scores) = OOBSearchCV.iterate_scores(forest, x, y, [n_estimators])
+    return scores
+
+
+def run_in_worker(
+    function: Callable[..., numpy.ndarray],
+    estimator: RandomForestClassifier,
+    *args: Any,
+) -> numpy.ndarray:
+    return function(estimator, *worker_data, *args)
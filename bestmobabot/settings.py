@@ -28,18 +28,27 @@ class ArenaSettings(BaseModel):
     friendly_clans: Set[str] = []  # names or clan IDs which must be skipped during enemy search
     early_stop: confloat(ge=0.0, le=1.0) = 0.95  # minimal win probability to stop enemy search
     last_battles: conint(ge=1) = constants.MODEL_N_LAST_BATTLES  # use last N battles for training
+    trainer_processes: conint(ge=1) = 1  # number of processes to fit the model in parallel
+    solver_processes: conint(ge=1) = 1  # number of processes to solve enemies in parallel
+    solution_ttl: Optional[timedelta] = timedelta(hours=12)  # for how long the found solutions are reused
+    surrogate_factor: conint(ge=1) = 1  # how many times more children are ranked by the linear surrogate
+    solver_memory_limit: Optional[conint(ge=1)] = None  # approximate memory limit of the solver in megabytes
 
     # Normal arena.
     normal_max_pages: conint(ge=1) = 15  # maximal number of pages during normal enemy search
     normal_generations_count_down: conint(ge=1) = 25
     normal_generate_solutions: conint(ge=1) = 100
     normal_keep_solutions: conint(ge=1) = 50
+    normal_enemy_time_budget: Optional[timedelta] = None  # maximum time to solve a single enemy
+    normal_time_budget: Optional[timedelta] = None  # maximum time of the entire enemy search
 
     # Grand arena.
     grand_max_pages: conint(ge=1) = 15  # maximal number of pages during grand enemy search
     grand_generations_count_down: conint(ge=1) = 50  # maximum number of GA iterations without any improvement
     grand_generate_solutions: conint(ge=1) = 500
     grand_keep_solutions: conint(ge=1) = 50
+    grand_enemy_time_budget: Optional[timedelta] = None  # maximum time to solve a single enemy
+    grand_time_budget: Optional[timedelta] = None  # maximum time of the entire enemy search
     randomize_grand_defenders: bool = False
 
 
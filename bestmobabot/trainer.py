@@ -24,7 +24,21 @@ from bestmobabot.model import Trainer
     help='Use N last battles for training.',
     show_default=True,
 )
-def main(verbosity: int, n_splits: int, n_last_battles: int):
+@click.option(
+    '--n-processes',
+    type=int,
+    default=1,
+    help='Number of processes to fit the folds in parallel.',
+    show_default=True,
+)
+@click.option(
+    '--search',
+    type=click.Choice(['halving', 'cv', 'oob']),
+    default='halving',
+    help='Hyper-parameter search: subsample screening and k-fold cross-validation, full k-fold or out-of-bag.',
+    show_default=True,
+)
+def main(verbosity: int, n_splits: int, n_last_battles: int, n_processes: int, search: str):
     """
     Train and generate arena prediction model.
     """
@@ -33,7 +47,7 @@ def main(verbosity: int, n_splits: int, n_last_battles: int):
         warnings.simplefilter('ignore')
 
     with Database(constants.DATABASE_NAME) as db:
-        Trainer(db, n_splits=n_splits, n_last_battles=n_last_battles).train()
+        Trainer(db, n_splits=n_splits, n_last_battles=n_last_battles, n_processes=n_processes, search=search).train()
 
 
 if __name__ == '__main__':
@@ -19,8 +19,8 @@ setuptools.setup(
     python_requires='>=3.8',
     install_requires=[
         'click',
+        'joblib',
         'numpy',
-        'pandas',
         'pydantic',
         'pyyaml',
         'requests',
@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+import pickle
+from pathlib import Path
+from typing import List
+
+from pytest import fixture
+
+from bestmobabot.dataclasses_ import GrandArenaEnemy, Hero
+
+DUMPS_PATH = Path(__file__).parent.parent / 'dumps'
+
+
+@fixture(scope='module')
+def heroes() -> List[Hero]:
+    return pickle.loads((DUMPS_PATH / 'heroes.pkl').read_bytes())
+
+
+@fixture(scope='module')
+def grand_enemies() -> List[GrandArenaEnemy]:
+    return pickle.loads((DUMPS_PATH / 'grand_enemies.pkl').read_bytes())
@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+from datetime import timedelta
+from time import monotonic
+from typing import Any, List
+
+import numpy
+from pytest import fixture
+from sklearn.ensemble import RandomForestClassifier
+
+from bestmobabot import constants
+from bestmobabot.arena import ArenaSolution, ArenaSolver, EnemySearch, PredictionMemo, reduce_at_least
+from bestmobabot.database import Database
+from bestmobabot.dataclasses_ import GrandArenaEnemy, Hero
+from bestmobabot.features import get_hero_features
+from bestmobabot.model import LinearSurrogate, Model
+
+
+@fixture(scope='module')
+def model(heroes: List[Hero]) -> Model:
+    random_state = numpy.random.RandomState(42)
+    feature_names = sorted({name for hero in heroes for name in get_hero_features(hero)})
+    x = random_state.normal(size=(200, len(feature_names)))
+    y = x[:, 0] + random_state.normal(size=200) > 0.0
+    return Model(
+        RandomForestClassifier(n_estimators=5, random_state=42).fit(x, y),
+        feature_names,
+        surrogate=LinearSurrogate.fit(x, y),
+    )
+
+
+def make_solver(model: Model, heroes: List[Hero], **kwargs: Any) -> ArenaSolver:
+    return ArenaSolver(
+        db={},
+        model=model,
+        user_clan_id=None,
+        heroes=heroes,
+        n_required_teams=constants.N_GRAND_TEAMS,
+        max_iterations=1,
+        n_keep_solutions=10,
+        n_generate_solutions=20,
+        n_generations_count_down=3,
+        early_stop=0.95,
+        get_enemies=list,
+        friendly_clans=[],
+        callback=lambda n_page: None,
+        **kwargs,
+    ).initialize()
+
+
+def test_solve_enemies(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solutions = make_solver(model, heroes).solve_enemies(grand_enemies)
+    assert [solution.enemy for solution in solutions] == grand_enemies
+    for solution in solutions:
+        assert 0.0 <= solution.probability <= 1.0
+        assert len(solution.probabilities) == constants.N_GRAND_TEAMS
+        attacker_ids = [hero.id for team in solution.attackers for hero in team]
+        assert len(attacker_ids) == len(set(attacker_ids)) == constants.N_GRAND_HEROES
+
+
+def test_make_team_features(model: Model, heroes: List[Hero]):
+    solver = make_solver(model, heroes)
+    expected = [
+        [features.get(name, 0.0) for name in model.feature_names]
+        for features in map(get_hero_features, heroes)
+    ]
+    numpy.testing.assert_array_equal(solver.make_sparse_features(heroes).toarray(), expected)
+    numpy.testing.assert_array_equal(
+        solver.make_team_features(heroes),
+        numpy.array(expected)[:, solver.model.forest.used_features],
+    )
+
+
+def test_team_features(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    search = EnemySearch(solver, grand_enemies[0], solver.make_team_features(heroes), None)
+    for _ in range(3):
+        search.select(solver.model.forest.predict_used_proba(search.generate()[0]))
+    expected = [search.hero_features[search.solutions[:, selector]].sum(axis=1) for selector in search.team_selectors]
+    numpy.testing.assert_array_equal(search.team_features, expected)
+
+
+def test_polish(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    search = EnemySearch(solver, grand_enemies[0], solver.make_team_features(heroes), None)
+    while not search.is_finished:
+        search.select(solver.model.forest.predict_used_proba(search.generate()[0]))
+    assert search.is_polishing
+
+    # The solution must be a local optimum.
+    search.is_finished = False
+    search.select(solver.model.forest.predict_used_proba(search.generate()[0]))
+    assert search.is_finished
+
+
+def test_seed(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    [(seeds, probability), _] = solver.make_seeds(grand_enemies[:2], solver.hero_features)
+    assert seeds.shape == (5, len(heroes))
+    for seed in seeds:
+        assert sorted(seed) == list(range(len(heroes)))
+    assert 0.0 <= probability <= 1.0
+
+
+def test_screen_enemies(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    assert solver.screen_enemies(grand_enemies)
+    solver.cache['1'] = ArenaSolution(grand_enemies[0], [], 1.0 + constants.ARENA_SCREENING_MARGIN, [])
+    assert solver.screen_enemies(grand_enemies) == []
+
+
+def test_screened_out_page(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    cached_solution = ArenaSolution(grand_enemies[0], [], 1.2, [])
+    solver.cache[grand_enemies[0].user_id] = cached_solution
+    pages = iter([grand_enemies[1:], grand_enemies[:1]])
+    solver.get_enemies = lambda: next(pages)
+    solver.max_iterations = 2
+    assert solver.solve() is cached_solution
+
+
+def test_enemy_time_budget(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    solver.n_generations_count_down = 1000
+    search = EnemySearch(solver, grand_enemies[0], solver.make_team_features(heroes), monotonic())
+    search.select(solver.model.forest.predict_used_proba(search.generate()[0]))
+    assert search.is_finished
+
+
+def test_time_budget(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    n_pages = []
+    solver = make_solver(model, heroes)
+    solver.get_enemies = lambda: n_pages.append(1) or grand_enemies
+    solver.max_iterations = 3
+    solver.early_stop = 1.0
+    solver.time_budget = timedelta()
+    # The first page is still solved, and the next one isn't fetched.
+    assert solver.solve() is not None
+    assert len(n_pages) == 1
+
+
+def test_prediction_memo():
+    memo = PredictionMemo(max_size=2, chunk_size=1)
+    predicted = []
+
+    def predict_proba(x: numpy.ndarray) -> numpy.ndarray:
+        predicted.extend(x[:, 0].tolist())
+        return x[:, 0] / 10.0
+
+    x = numpy.array([[1.0], [2.0], [1.0]])
+    numpy.testing.assert_array_equal(memo.predict(numpy.array([1, 2, 1]), x, predict_proba), [0.1, 0.2, 0.1])
+    numpy.testing.assert_array_equal(memo.predict(numpy.array([2, 3]), x[1:], predict_proba), [0.2, 0.1])
+    assert predicted == [1.0, 2.0, 1.0]
+    assert list(memo.probabilities) == [2, 3]
+    assert (memo.n_hits, memo.n_misses) == (2, 3)
+
+
+def test_memory_limit(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    solver.n_keep_solutions = 10000
+    solver.n_generate_solutions = 10000
+    solver.memory_limit = 40
+    solver.shrink_population()
+    assert solver.n_generate_solutions < 10000
+    assert solver.estimate_memory() <= solver.memory_limit
+
+    # The enemies are solved one by one.
+    solver.memory_limit = max(1, solver.estimate_memory())
+    solver.initialize()
+    solutions = solver.solve_enemies(grand_enemies)
+    assert [solution.enemy for solution in solutions] == grand_enemies
+    assert solver.solutions.shape == (solver.n_keep_solutions, len(heroes))
+
+
+def test_solve_parallel(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes)
+    solver.get_enemies = lambda: grand_enemies
+    solver.n_processes = 2
+    solver.load_solutions = lambda: initial_solutions.append(solver.solutions)
+    initial_solutions = []
+    solution = solver.solve()
+    assert solution.enemy.user_id in {enemy.user_id for enemy in grand_enemies}
+    assert solver.executor is None
+    # The population comes back from the workers.
+    assert solver.solutions is not initial_solutions[0]
+    assert solver.solutions.shape[1] == initial_solutions[0].shape[1]
+
+
+def test_solve_database(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    db = Database(':memory:')
+
+    def get_enemies() -> List[GrandArenaEnemy]:
+        # The API stores the request ID on each call, and it's called from the prefetching thread.
+        db['api:request_id'] = db.get('api:request_id', 0) + 1
+        return grand_enemies
+
+    solver = make_solver(model, heroes, user_id='1')
+    solver.db = db
+    solver.max_iterations = 3
+    solver.early_stop = 0.0
+    solver.get_enemies = get_enemies
+    assert solver.solve() is not None
+    assert db['api:request_id'] == 2  # the page prefetched before the early stop is discarded
+    assert db[solver.population_key]
+
+
+def test_population(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    db = {}
+    solver = make_solver(model, heroes)
+    solver.db = db
+    solver.user_id = '1'
+    solver.get_enemies = lambda: grand_enemies[:1]
+    solution = solver.solve()
+    layouts = db[solver.population_key]
+    assert layouts[0] == [hero.id for team in solution.attackers for hero in team]
+    assert len(layouts) <= solver.n_keep_solutions
+
+    # One hero is gone, the restored population must be valid permutations of the rest.
+    solver = make_solver(model, heroes[1:])
+    solver.db = db
+    solver.user_id = '1'
+    solver.initialize()
+    assert solver.solutions.shape == (solver.n_keep_solutions, len(heroes) - 1)
+    for row in solver.solutions:
+        assert sorted(row) == list(range(len(heroes) - 1))
+    # The rest of the heroes must stay in their places.
+    restored_layout = [solver.heroes[index].id for index in solver.solutions[0]]
+    for restored_id, stored_id in zip(restored_layout, layouts[0]):
+        assert restored_id == stored_id or stored_id == heroes[0].id
+
+
+def test_stored_solutions(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    db = Database(':memory:')
+    solver = make_solver(model, heroes)
+    solver.db = db
+    solver.solution_ttl = timedelta(hours=1)
+    solver.get_enemies = lambda: grand_enemies[:1]
+    solution = solver.solve()
+    assert len(db.get_keys_by_prefix(solver.solution_prefix)) == 1
+
+    # The same match-up is answered without solving.
+    solver = make_solver(model, heroes)
+    solver.db = db
+    solver.solution_ttl = timedelta(hours=1)
+    solver.get_enemies = lambda: grand_enemies[:1]
+    stored_solution = solver.solve()
+    assert solver.n_predict_calls == 0
+    assert stored_solution.attackers == solution.attackers
+    assert stored_solution.probability == solution.probability
+
+    # Our heroes have changed.
+    solver = make_solver(model, heroes[1:])
+    solver.db = db
+    solver.solution_ttl = timedelta(hours=1)
+    solver.initialize()
+    assert solver.get_stored_solution(grand_enemies[0]) is None
+
+
+def test_stored_solutions_expire(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    db = Database(':memory:')
+    solver = make_solver(model, heroes)
+    solver.db = db
+    solver.solution_ttl = timedelta()
+    solver.initialize()
+    attackers = [heroes[:5], heroes[5:10], heroes[10:15]]
+    solver.store_solution(ArenaSolution(grand_enemies[0], attackers, 0.5, [0.5, 0.5, 0.5]))
+    assert solver.get_stored_solution(grand_enemies[0]) is None
+    solver.initialize()
+    assert db.get_keys_by_prefix(solver.solution_prefix) == []
+
+
+def test_surrogate(model: Model, heroes: List[Hero], grand_enemies: List[GrandArenaEnemy]):
+    solver = make_solver(model, heroes, surrogate_factor=3)
+    search = EnemySearch(solver, grand_enemies[0], solver.hero_features, None)
+    hero_features = solver.make_sparse_features(heroes).toarray()
+    defenders_features = [solver.make_sparse_features(team).toarray().sum(axis=0) for team in grand_enemies[0].teams]
+
+    def predict_surrogate(parents: numpy.ndarray, swap_indexes: numpy.ndarray) -> numpy.ndarray:
+        solutions, _ = search.make_children(parents, swap_indexes)
+        return solver.reduce_probabilities(*(
+            model.surrogate.predict_proba(hero_features[solutions[:, selector]].sum(axis=1) - features)
+            for selector, features in zip(search.team_selectors, defenders_features)
+        ))
+
+    # The incrementally scored top children must be the actual top ones.
+    parents = numpy.arange(search.solutions.shape[0]).repeat(3)
+    swap_indexes = numpy.random.randint(0, search.swaps.shape[0], parents.shape[0])
+    y = predict_surrogate(parents, swap_indexes)
+    y_top = predict_surrogate(*search.screen_children(parents, swap_indexes, 5))
+    numpy.testing.assert_allclose(numpy.sort(y_top), numpy.sort(y)[-5:])
+
+    solution = solver.solve_enemy(grand_enemies[0])
+    assert len({hero.id for team in solution.attackers for hero in team}) == constants.N_GRAND_HEROES
+
+
+def test_reduce_at_least():
+    y1, y2, y3 = numpy.random.RandomState(42).uniform(size=(3, 10))
+    numpy.testing.assert_array_equal(reduce_at_least(1, y1), y1)
+    numpy.testing.assert_allclose(
+        reduce_at_least(2, y1, y2, y3),
+        y1 * y2 * y3 + y1 * y2 * (1.0 - y3) + y2 * y3 * (1.0 - y1) + y1 * y3 * (1.0 - y2),
+    )
+    numpy.testing.assert_allclose(reduce_at_least(3, y1, y2, y3), y1 * y2 * y3)
+    assert reduce_at_least(2, *numpy.full((4, 1), 0.5))[0] == 11 / 16
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
 from bestmobabot.database import Database
@@ -38,3 +40,26 @@ def test_get_by_prefix():
     db['foo:qux'] = 42
     db['foo:quux'] = 43
     assert list(db.get_by_prefix('foo')) == [('foo:qux', 42), ('foo:quux', 43)]
+
+
+def test_get_keys_by_prefix():
+    db = Database(':memory:')
+    db['foo:qux'] = 42
+    db['bar:quux'] = 43
+    assert db.get_keys_by_prefix('foo') == ['foo:qux']
+
+
+def test_delete():
+    db = Database(':memory:')
+    db['foo'] = 42
+    del db['foo']
+    assert 'foo' not in db
+    with pytest.raises(KeyError):
+        del db['foo']
+
+
+def test_other_thread():
+    db = Database(':memory:')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(db.__setitem__, 'foo', 42).result()
+    assert db['foo'] == 42
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from typing import List
+
+import numpy
+
+from bestmobabot.dataclasses_ import Hero
+from bestmobabot.features import FeatureVectorizer, HeroTable, get_hero_features
+
+
+def test_get_hero_features(heroes: List[Hero]):
+    hero = heroes[0]
+    features = get_hero_features(hero)
+    assert features['total_heroes'] == 1.0
+    assert features['total_color_level_star'] == hero.color * hero.level * hero.star
+    assert features[f'level_{hero.id}'] == hero.level
+    assert features[f'skin_{hero.id}'] == hero.skin_level
+    for name in features:
+        assert name.startswith('total_') or hero.id in name
+
+
+def test_transform(heroes: List[Hero]):
+    feature_names = sorted({name for hero in heroes[1:] for name in get_hero_features(hero)})
+    x = FeatureVectorizer(feature_names).transform(heroes)
+    expected = [[features.get(name, 0.0) for name in feature_names] for features in map(get_hero_features, heroes)]
+    numpy.testing.assert_array_equal(x.toarray(), expected)
+
+
+def test_transform_fitting(heroes: List[Hero]):
+    vectorizer = FeatureVectorizer(is_fitting=True)
+    x = vectorizer.transform(heroes)
+    assert sorted(vectorizer.feature_names) == sorted({name for hero in heroes for name in get_hero_features(hero)})
+    expected = [
+        [features.get(name, 0.0) for name in vectorizer.feature_names]
+        for features in map(get_hero_features, heroes)
+    ]
+    numpy.testing.assert_array_equal(x.toarray(), expected)
+
+
+def test_hero_table(heroes: List[Hero]):
+    vectorizer = FeatureVectorizer(is_fitting=True)
+    table = HeroTable(heroes, vectorizer)
+    assert list(table) == heroes
+    assert table.ids.tolist() == [hero.id for hero in heroes]
+    assert table.power.tolist() == [hero.power or 0 for hero in heroes]
+    assert table.color.tolist() == [hero.color for hero in heroes]
+    assert table.take([2, 0]) == [heroes[2], heroes[0]]
+    expected = [
+        [features.get(name, 0.0) for name in vectorizer.feature_names]
+        for features in map(get_hero_features, heroes)
+    ]
+    numpy.testing.assert_array_equal(table.features.toarray(), expected)
@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+from itertools import combinations
+from typing import List
+
+import pytest
+from pytest import fixture
+
+from bestmobabot import constants
+from bestmobabot.dataclasses_ import Hero
+from bestmobabot.features import HeroTable
+from bestmobabot.helpers import find_expedition_team, get_team_power, naive_select_attackers
+
+
+@fixture(scope='module')
+def heroes(heroes: List[Hero]) -> List[Hero]:
+    return heroes[:12]
+
+
+def test_naive_select_attackers(heroes: List[Hero]):
+    expected = sorted(heroes, key=lambda hero: hero.power, reverse=True)[:constants.N_GRAND_HEROES]
+    assert naive_select_attackers(HeroTable(heroes), count=constants.N_GRAND_HEROES) == expected
+
+
+@pytest.mark.parametrize('quantile', [0.0, 0.5, 0.9, 1.0])
+def test_find_expedition_team(heroes: List[Hero], quantile: float, monkeypatch):
+    monkeypatch.setattr(constants, 'EXPEDITION_TEAMS_CHUNK_SIZE', 100)
+    teams = list(combinations(heroes, constants.TEAM_SIZE))
+    powers = sorted(get_team_power(team) for team in teams)
+    min_power = powers[int(quantile * (len(powers) - 1))]
+    expected = min((team for team in teams if get_team_power(team) >= min_power), key=get_team_power)
+    assert find_expedition_team(HeroTable(heroes), min_power) == list(expected)
+
+
+def test_find_expedition_team_none(heroes: List[Hero]):
+    assert find_expedition_team(HeroTable(heroes), 10 ** 9) is None
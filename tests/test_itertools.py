@@ -4,7 +4,7 @@ from typing import List
 
 import pytest
 
-from bestmobabot.itertools_ import secretary_max, slices
+from bestmobabot.itertools_ import prefetch, secretary_max, slices
 
 
 @pytest.mark.parametrize('n, length, expected', [
@@ -54,3 +54,32 @@ def test_secretary_max_early_stop(items, early_stop, expected, next_):
     iterator = iter(items)
     assert secretary_max(iterator, len(items), early_stop=early_stop) == expected
     assert next(iterator, None) == next_  # test the iterator position
+
+
+@pytest.mark.parametrize('items, n, expected', [
+    ([], 1, None),
+    ([1], 3, 1),
+    ([5, 1], 4, 5),
+])
+def test_secretary_max_exhausted(items, n, expected):
+    assert secretary_max(iter(items), n) == expected
+
+
+def test_prefetch():
+    calls = iter(range(100))
+    assert list(prefetch(lambda: next(calls), 3)) == [0, 1, 2]
+    assert next(calls) == 3  # no extra calls
+
+
+def test_prefetch_close():
+    calls = iter(range(100))
+    items = prefetch(lambda: next(calls), 3)
+    assert next(items) == 0
+    items.close()
+    assert next(calls) == 2  # the second item has been prefetched
+
+
+def test_prefetch_stopped():
+    calls = iter(range(100))
+    assert list(prefetch(lambda: next(calls), 3, lambda: True)) == [0]
+    assert next(calls) == 1  # the next item is not requested
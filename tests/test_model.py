@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+from typing import List
+
+import numpy
+from pytest import mark, raises
+from scipy.sparse import csr_matrix
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import KFold, cross_val_score
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import MaxAbsScaler
+
+from bestmobabot import constants
+from bestmobabot.database import Database
+from bestmobabot.dataclasses_ import Hero
+from bestmobabot.features import get_hero_features
+from bestmobabot.model import (
+    BattleChunk,
+    BattleStore,
+    CompiledForest,
+    HalvingTTestSearchCV,
+    LinearSurrogate,
+    Model,
+    OOBSearchCV,
+    Trainer,
+    TTestSearchCV,
+)
+
+
+@mark.parametrize('n_estimators, max_depth', [(1, None), (10, 3), (25, None)])
+def test_compiled_forest(n_estimators: int, max_depth: int):
+    random_state = numpy.random.RandomState(42)
+    x = random_state.normal(size=(500, 20))
+    y = x[:, 0] + x[:, 1] * x[:, 2] + random_state.normal(size=500) > 0.0
+    estimator = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=42).fit(x, y)
+
+    x_test = random_state.normal(size=(100, 20))
+    expected = estimator.predict_proba(x_test)[:, 1]
+    assert numpy.array_equal(CompiledForest(estimator).predict_proba(x_test), expected)
+
+
+def test_model_dumps_loads():
+    estimator = RandomForestClassifier(n_estimators=2).fit([[0.0], [1.0]], [False, True])
+    model = Model.loads(Model(estimator, ['feature']).dumps())
+    assert model.feature_names == ['feature']
+    assert isinstance(model.forest, CompiledForest)
+
+
+def test_linear_surrogate():
+    random_state = numpy.random.RandomState(42)
+    x = random_state.normal(size=(100, 3)) * [1.0, 10.0, 100.0]
+    y = x[:, 0] + random_state.normal(size=100) > 0.0
+    surrogate = LinearSurrogate.fit(x, y)
+    expected = make_pipeline(MaxAbsScaler(), LogisticRegression(class_weight='balanced', max_iter=1000)).fit(x, y)
+    numpy.testing.assert_allclose(surrogate.predict_proba(x), expected.predict_proba(x)[:, 1])
+
+
+def test_parse_battles(heroes: List[Hero]):
+    teams = [hero.dict(by_alias=True) for hero in heroes[:5]], [hero.dict(by_alias=True) for hero in heroes[5:10]]
+    battles = BattleChunk.parse([
+        ('1', {'win': True, 'attackers': teams[0], 'defenders': teams[1]}),
+        ('2', {'win': False, 'player': teams[1], 'enemies': teams[0]}),
+        ('3', {'win': True, 'attackers': teams[0], 'defenders': teams[1]}),
+    ])
+    x, y = Trainer.deduplicate_battles(battles.x, battles.y)
+    feature_names = battles.feature_names
+    assert y.tolist() == [True, False]
+
+    expected = numpy.zeros((2, len(feature_names)))
+    for row, battle_teams in enumerate([(heroes[:5], heroes[5:10]), (heroes[5:10], heroes[:5])]):
+        for team, multiplier in zip(battle_teams, (+1.0, -1.0)):
+            for hero in team:
+                for name, value in get_hero_features(hero).items():
+                    if name in feature_names:
+                        expected[row, feature_names.index(name)] += multiplier * value
+    numpy.testing.assert_array_equal(x.toarray(), expected)
+
+
+def test_battle_store(heroes: List[Hero], monkeypatch):
+    monkeypatch.setattr(constants, 'MODEL_BATTLES_CHUNK_SIZE', 2)
+    replays = [
+        (str(i), {
+            'start_time': float(-i),
+            'win': i % 2 == 0,
+            'attackers': [hero.dict() for hero in heroes[i:i + 5]],
+            'defenders': [hero.dict() for hero in heroes[i + 5:i + 10]],
+        })
+        for i in range(7)
+    ]
+    db = Database(':memory:')
+    store = BattleStore(db)
+    store.add(replays[:3])
+    store.add(replays[3:4])
+    store.add(replays[4:])
+    store.add(replays[6:])  # duplicate
+    assert len(db.get_keys_by_prefix(store.prefix)) == 6
+    db['battles:0123'] = db['battles:v0:4567'] = BattleChunk.parse(replays[:1]).dumps()  # outdated features
+
+    # The small chunks are merged, and the outdated ones are discarded.
+    battles = store.load().take_last(5)
+    assert len(db.get_keys_by_prefix(store.prefix)) == 4
+    assert len(db.get_keys_by_prefix('battles:')) == 4
+    assert battles.ids == ['4', '3', '2', '1', '0']
+    assert battles.y.tolist() == [True, False, True, False, True]
+
+    expected = BattleChunk.parse(replays).take(numpy.arange(4, -1, -1))
+    columns = [expected.feature_names.index(name) for name in battles.feature_names]
+    assert sorted(columns) == list(range(len(expected.feature_names)))
+    numpy.testing.assert_array_equal(battles.x.toarray(), expected.x.toarray()[:, columns])
+
+
+def test_ttest_search_cv_prefix_forests():
+    random_state = numpy.random.RandomState(42)
+    x = random_state.normal(size=(300, 10))
+    y = x[:, 0] + random_state.normal(size=300) > 0.0
+    estimator = RandomForestClassifier(class_weight='balanced', random_state=42)
+    search_cv = TTestSearchCV(estimator, {'n_estimators': [10, 2, 5]}, cv=KFold(n_splits=3), scoring='accuracy')
+
+    # Truncated forests are scored the same as the ones fitted from scratch.
+    results = list(search_cv.cross_validate(x, y))
+    assert [params for params, _ in results] == [{'n_estimators': 2}, {'n_estimators': 5}, {'n_estimators': 10}]
+    for params, scores in results:
+        expected = cross_val_score(clone(estimator).set_params(**params), x, y, scoring='accuracy', cv=KFold(3))
+        numpy.testing.assert_array_equal(scores, expected)
+
+    search_cv.fit(x, y)
+    assert search_cv.best_params_ in [params for params, _ in results]
+
+
+def test_ttest_search_cv_parallel():
+    random_state = numpy.random.RandomState(42)
+    x = csr_matrix(random_state.normal(size=(200, 5)))
+    y = x[:, 0].toarray().ravel() + random_state.normal(size=200) > 0.0
+    estimator = RandomForestClassifier(random_state=42)
+    param_grid = {'n_estimators': [2, 5], 'max_depth': [2, None]}
+    expected = list(TTestSearchCV(estimator, param_grid, cv=KFold(3), scoring='accuracy').cross_validate(x, y))
+    search_cv = TTestSearchCV(estimator, param_grid, cv=KFold(3), scoring='accuracy', n_processes=2)
+    results = list(search_cv.cross_validate(x, y))
+    assert [params for params, _ in results] == [params for params, _ in expected]
+    for (_, scores), (_, expected_scores) in zip(results, expected):
+        numpy.testing.assert_array_equal(scores, expected_scores)
+
+
+def test_oob_search_cv():
+    random_state = numpy.random.RandomState(42)
+    x = csr_matrix(random_state.normal(size=(300, 5)))
+    y = x[:, 0].toarray().ravel() + random_state.normal(size=300) > 0.0
+    estimator = RandomForestClassifier(class_weight='balanced', random_state=42)
+    search_cv = OOBSearchCV(estimator, {'n_estimators': [5, 50]})
+    results = list(search_cv.cross_validate(x, y))
+    assert [params for params, _ in results] == [{'n_estimators': 5}, {'n_estimators': 50}]
+
+    # The largest forest is scored the same as the forest does it.
+    expected = clone(estimator).set_params(n_estimators=50, oob_score=True).fit(x, y)
+    _, scores = results[-1]
+    assert scores.shape == (300,)
+    assert scores.mean() == expected.oob_score_
+
+    with raises(ValueError):
+        OOBSearchCV(estimator, {'n_estimators': [5, 50]}, scoring='roc_auc')
+
+    search_cv.fit(x, y)
+    assert len(search_cv.best_estimator_.estimators_) == search_cv.best_params_['n_estimators']
+
+
+def test_halving_ttest_search_cv():
+    random_state = numpy.random.RandomState(42)
+    x = random_state.normal(size=(300, 5))
+    y = x[:, 0] * x[:, 1] > 0.0
+    estimator = RandomForestClassifier(random_state=42)
+    param_grid = {'n_estimators': [2, 10], 'max_depth': [1, None]}
+    search_cv = HalvingTTestSearchCV(estimator, param_grid, cv=KFold(5), scoring='accuracy')
+    results = list(search_cv.cross_validate(x, y))
+    expected = list(TTestSearchCV(estimator, param_grid, cv=KFold(5), scoring='accuracy').cross_validate(x, y))
+
+    # The stumps are dropped early. The survivors are scored on all the folds, the same way as without halving.
+    assert results
+    for params, actual_scores in results:
+        assert params['max_depth'] is None
+        [expected_scores] = [scores for expected_params, scores in expected if expected_params == params]
+        numpy.testing.assert_array_equal(actual_scores, expected_scores)
+
+    search_cv.fit(x, y)
+    assert search_cv.best_params_['max_depth'] is None
+
+    # The subsamples are screened in the worker processes as well.
+    search_cv = HalvingTTestSearchCV(estimator, param_grid, cv=KFold(5), scoring='accuracy', n_processes=2)
+    search_cv.fit(x, y)
+    assert search_cv.best_params_['max_depth'] is None